@@ -0,0 +1,265 @@
+"""Solves and plots a batch of models from a JSONL file, in parallel on every
+core, through the same pipeline as the bot.
+
+    python batch.py models.jsonl --output results
+    python batch.py models.jsonl --output results --unordered --format csv
+
+Every line of the file defines a model, i.e.
+
+    {"name": "decay", "variables": ["N"], "equations": ["-k * N"],
+     "parameters": {"k": 0.5}, "ic": [100], "t_span": [0, 10], "points": 1000}
+
+The equations can also be given as a single string separated by commas, and
+use y[i] and p[i] instead of names. The initial conditions can be given by
+the name of their unknown. method, rtol, atol and backend are optional, see
+solver.create_model.
+
+The solution and the plots of every model are written to the output
+directory, named after its line and name, along with progress.jsonl, where
+every finished model is recorded as soon as it is done. Running the batch
+again skips the models already solved, so an interrupted batch resumes where
+it stopped. The results are printed as they finish, in the order of the file
+or, with --unordered, as soon as each one is done.
+"""
+import argparse
+import ast
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from export import FORMATS, write_csv, write_npz
+from equations import split_equations
+from metrics import stats
+from storage import references
+from solver import create_model, solve_model, plot_model, extension, PROFILES
+
+PROGRESS = 'progress.jsonl' # file of the output directory where the finished models are recorded
+SUMMARY = 'summary.json'    # file of the output directory where the throughput of the last run is written
+
+
+def substitute(equation, variables, parameters):
+    """Replaces the names of the unknowns and parameters of an equation by
+    y[i] and p[i], leaving the rest of the names, i.e. functions, as they are
+    Parameters
+    ----------
+    equation : str
+        Right hand side of the equation.
+    variables : list
+        Names of the unknowns.
+    parameters : list
+        Names of the parameters.
+    Returns
+    -------
+    str
+        Source of the equation.
+    """
+    names = {v: f'y[{i}]' for i, v in enumerate(variables)}
+    names.update({v: f'p[{i}]' for i, v in enumerate(parameters)})
+
+    class rename(ast.NodeTransformer):
+        def visit_Call(self, node):
+            # the function called keeps its name even if a parameter shares it, i.e. exp
+            if not isinstance(node.func, ast.Name):
+                node.func = self.visit(node.func)
+            node.args = [self.visit(arg) for arg in node.args]
+            node.keywords = [self.visit(keyword) for keyword in node.keywords]
+            return node
+
+        def visit_Name(self, node):
+            if node.id in names:
+                return ast.parse(names[node.id], mode='eval').body
+            return node
+
+    return ast.unparse(rename().visit(ast.parse(equation, mode='eval')))
+
+def parse_model(definition, name):
+    """Creates the model of a line of the batch
+    Parameters
+    ----------
+    definition : dict
+        Definition of the model, see the description of the module.
+    name : str
+        Name of the model.
+    Returns
+    -------
+    tuple
+        Model object and names of its unknowns.
+    """
+    equations = definition['equations']
+    equations = split_equations(equations if isinstance(equations, str) else ','.join(equations))
+    variables = definition.get('variables') or ['y' + str(i) for i in range(len(equations))]
+    if isinstance(variables, str):
+        variables = [v.strip() for v in variables.split(',')]
+    if len(variables) != len(equations):
+        raise ValueError('The number of variables must be equal to the number of equations.')
+
+    parameters = definition.get('parameters') or {}
+    p_names = list(parameters) if isinstance(parameters, dict) else []
+    p = [float(v) for v in (parameters.values() if isinstance(parameters, dict) else parameters)]
+
+    ic = definition['ic']
+    if isinstance(ic, dict):
+        ic = [ic[v] for v in variables]
+
+    f = ','.join(substitute(e, variables, p_names) for e in equations)
+    model = create_model(
+        name, f, [float(t) for t in definition['t_span']], [float(i) for i in ic],
+        t_eval=definition.get('points'), p=p or None, method=definition.get('method'),
+        rtol=definition.get('rtol'), atol=definition.get('atol'), backend=definition.get('backend'),
+    )
+    return model, variables
+
+def run(task):
+    """Job run by the processes of the pool. Solves and plots a model of the
+    batch, writing its solution and plots to the output directory
+    Parameters
+    ----------
+    task : tuple
+        Number of the line of the model in the file, hash of the line, the
+        line itself, output directory, format of the solution, rendering
+        profile and whether to plot it or not.
+    Returns
+    -------
+    dict
+        Record of the model: its line, hash, name, status, error message if
+        it failed, seconds taken, number of points and function evaluations,
+        why it stopped early if it did, and the files written.
+    """
+    index, key, line, output, fmt, profile, plot = task
+    record = {'line': index, 'key': key, 'name': f'model{index}'}
+    start = time.perf_counter()
+    try:
+        definition = json.loads(line)
+        if not isinstance(definition, dict):
+            raise ValueError('Every line must be a JSON object.')
+        name = record['name'] = str(definition.get('name', record['name']))
+        model, names = parse_model(definition, name)
+        sol = solve_model(model)
+        stem = os.path.join(output, f"{index:05d}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', name)}")
+        files = [f'{stem}.{fmt}' + ('.gz' if fmt == 'csv' else '')]
+        with open(files[0], 'wb') as file:
+            (write_csv if fmt == 'csv' else write_npz)(sol, file, names)
+        if plot:
+            for image, suffix in zip(plot_model(name, sol, profile=profile), ['', '3d']):
+                files.append(f'{stem}{suffix}.{extension(image)}')
+                with open(files[-1], 'wb') as file:
+                    file.write(image)
+        for path in references(sol): # exported, the memory-mapped solution is no longer needed
+            os.remove(path)
+    except Exception as e: # i.e. a malformed line or definition, the rest of the batch goes on
+        record.update(status='error', error=f'{type(e).__name__}: {e}')
+    else:
+        record.update(
+            status='ok', points=len(sol.t), nfev=int(sol.nfev), stopped=sol.get('stopped'),
+            files=[os.path.basename(f) for f in files],
+        )
+    record['seconds'] = time.perf_counter() - start
+    stats.drain() # the metrics are not reported, do not let them grow
+    return record
+
+def read_tasks(path, output, fmt, profile, plot):
+    """Returns the tasks of the lines of a JSONL file, see run, skipping the
+    blank ones. The lines are parsed by run, so a malformed one is recorded
+    as an error instead of stopping the batch"""
+    tasks = []
+    with open(path) as file:
+        for index, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            # the options change the files written, so changing them solves the models again
+            key = hashlib.sha256(json.dumps([line.strip(), fmt, profile, plot]).encode()).hexdigest()
+            tasks.append((index, key, line, output, fmt, profile, plot))
+    return tasks
+
+def read_progress(path):
+    """Returns the keys of the tasks already done, see read_tasks, recorded in
+    the progress file, along with their records"""
+    done = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # the last line of an interrupted batch
+                    continue
+                if record.get('status') == 'ok':
+                    done[record['key']] = record
+    return done
+
+def summarize(records, skipped, elapsed, workers):
+    """Returns the throughput of a run of the batch"""
+    ok = [r for r in records if r['status'] == 'ok']
+    busy = sum(r['seconds'] for r in records)
+    return {
+        'solved': len(ok), 'failed': len(records) - len(ok), 'skipped': skipped,
+        'seconds': elapsed, 'workers': workers,
+        'models_per_second': len(records) / elapsed if elapsed else 0.0,
+        'points_per_second': sum(r['points'] for r in ok) / elapsed if elapsed else 0.0,
+        'mean_seconds': busy / len(records) if records else 0.0,
+        # fraction of the time the workers were busy solving
+        'utilization': busy / (elapsed * workers) if elapsed else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('models', help='JSONL file with a model per line')
+    parser.add_argument('--output', default='results', help='directory where the results are written')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, one per core by default')
+    parser.add_argument('--unordered', action='store_true', help='print the results as they finish instead of in order')
+    parser.add_argument('--format', choices=FORMATS, default='npz', help='format of the solutions')
+    parser.add_argument('--profile', choices=list(PROFILES), default='file', help='rendering profile of the plots')
+    parser.add_argument('--no-plots', action='store_true', help='only write the solutions')
+    parser.add_argument('--restart', action='store_true', help='solve again the models already solved')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    progress = os.path.join(args.output, PROGRESS)
+    if args.restart and os.path.exists(progress):
+        os.remove(progress)
+
+    tasks = read_tasks(args.models, args.output, args.format, args.profile, not args.no_plots)
+    done = read_progress(progress)
+    pending = [task for task in tasks if task[1] not in done]
+    skipped = len(tasks) - len(pending)
+    if skipped:
+        print(f'resuming, {skipped} of {len(tasks)} models already solved', file=sys.stderr)
+
+    workers = min(args.workers or os.cpu_count() or 1, max(len(pending), 1))
+    records = []
+    start = time.perf_counter()
+    interrupted = False
+    with open(progress, 'a') as log, multiprocessing.Pool(workers) as pool:
+        results = (pool.imap_unordered if args.unordered else pool.imap)(run, pending)
+        try:
+            for record in results:
+                records.append(record)
+                log.write(json.dumps(record) + '\n')
+                log.flush() # recorded as soon as it is done, so an interruption loses no finished model
+                detail = f"{record['points']} points" if record['status'] == 'ok' else record['error']
+                print(f"{record['line']:>6} {record['name']:>20} {record['status']:>5} {record['seconds']:8.3f} s  {detail}")
+        except KeyboardInterrupt:
+            interrupted = True
+            pool.terminate()
+
+    summary = summarize(records, skipped, time.perf_counter() - start, workers)
+    with open(os.path.join(args.output, SUMMARY), 'w') as file:
+        json.dump(summary, file, indent=2)
+    print(
+        f"{summary['solved']} solved, {summary['failed']} failed, {summary['skipped']} skipped in "
+        f"{summary['seconds']:.2f} s: {summary['models_per_second']:.2f} models/s, "
+        f"{summary['points_per_second']:.0f} points/s, {summary['utilization']:.0%} of {workers} workers busy",
+        file=sys.stderr,
+    )
+    if interrupted:
+        print('interrupted, run it again to resume', file=sys.stderr)
+        sys.exit(130)
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
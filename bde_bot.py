@@ -1,24 +1,47 @@
 import logging
+import asyncio
 import traceback
-from collections import deque
 import ast
 import math
+import hashlib
+import functools
+import html
+import importlib
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
 from model import model
-from solver import create_model, solve_model, plot_model, ideal, asymmetric, spiral, love_func
-from config import TOKEN
+from workers import pool, PoolBusy, JobTimeout, solve_and_plot, sweep_and_plot, export_solution
+from export import FORMATS, filename
+from scheduler import scheduler, UserBusy, JobCancelled
+from cache import solution_cache
+from metrics import stats
+from lazy import lazy_module
+from session import session, sqlite_persistence, expired, trim
+from updates import chat_ordered_application
+from config import (
+    TOKEN, BASE_URL, ADMINS, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_CONNECTIONS,
+    POLL_TIMEOUT, POLL_INTERVAL, CONCURRENT_UPDATES, UPDATE_BACKLOG, CONNECTION_POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT,
+    WRITE_TIMEOUT, POOL_TIMEOUT, METRICS_FILE, METRICS_INTERVAL, WORKERS, QUEUE_SIZE, JOB_TIMEOUT, USER_JOBS, CACHE_SIZE, CACHE_DIR, CACHE_DISK_SIZE, MAX_FILE_IDS,
+    MAX_SWEEP, WARMUP, WARMUP_CHAT_ID, SESSION_FILE, SESSION_TTL, MAX_SESSIONS, SESSION_MEMORY, SESSION_INTERVAL
+)
+
 
+# the numeric stack is imported on first use, or in the background once the
+# bot starts, see post_init, so the bot starts answering right away
+solver = lazy_module('solver')
+storage = lazy_module('storage')
 
 # Enable logging
 logging.basicConfig(
@@ -27,17 +50,58 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# models are solved and plotted in worker processes, off the event loop
+solver_pool = pool(WORKERS, QUEUE_SIZE, JOB_TIMEOUT)
+# jobs wait here, taking turns between chats, until a worker is free
+solver_scheduler = scheduler(solver_pool, USER_JOBS, QUEUE_SIZE)
+# solutions and plots of the models already solved, by their canonical hash
+solutions = solution_cache(CACHE_SIZE, CACHE_DIR, CACHE_DISK_SIZE)
+# solutions and plots of the tutorial models, solved when the bot starts and never evicted
+warmed = {}
+# tasks running alongside the bot, referenced so they are not garbage collected
+background_tasks = set()
+# the state of every user is a session record instead of a dict, see session.py
+context_types = ContextTypes(user_data=session)
+# import of the numeric stack running in a thread, see load_solver
+solver_import = None
+# users whose session was discarded, maybe in the middle of a conversation, see evict_sessions
+expired_users = filters.User(allow_empty=False)
+
+def load_solver():
+    """Imports the numeric stack in a thread, once, so the bot keeps
+    answering meanwhile. Returns the task of the import, awaited by whatever
+    uses the numeric stack before it is done instead of importing it on the
+    event loop"""
+    global solver_import
+    if solver_import is None or (not solver_import.done() and solver_import.get_loop() is not asyncio.get_running_loop()):
+        async def load():
+            with stats.timer('startup.import'):
+                await asyncio.to_thread(importlib.import_module, 'solver')
+        solver_import = asyncio.ensure_future(load())
+    return solver_import
+
+def needs_solver(handler):
+    """Decorates a handler using the numeric stack, so it waits for its
+    import, see load_solver"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await load_solver()
+        return await handler(update, context)
+    return wrapper
+
 # ------------------------- CONVERSATION STATES ----------------------------#
-SCENARIO, SOLVE_OR_EDIT_TUTORIAL, INPUT_IC_TUTORIAL = range(3)
-VARIABLES, EQUATION, TS_IC, PARAMETERS, SOLVE_OR_EDIT, EDIT, EDITED = range(7)
+SCENARIO, SOLVE_OR_EDIT_TUTORIAL, INPUT_IC_TUTORIAL, SWEEP_TUTORIAL = range(4)
+VARIABLES, EQUATION, TS_IC, PARAMETERS, SOLVE_OR_EDIT, EDIT, EDITED, SWEEP, EXPORT = range(9)
 
 # ------------------------------ KEYBOARDS ---------------------------------#
 keyboards = {
     "main" : [["/create", "/tutorial"]],
     "rj": [["Relación ideal", "Relación asimétrica"], ["Relación espiral", "/cancel"]],
-    "solve_or_edit": [["solve", "edit"], ['/cancel']],
+    "solve_or_edit": [["solve", "edit"], ["sweep", '/cancel']],
     "edit": [["edit", "/cancel"]],
-    "edit_options": [["parameters", "initial conditions"], ["time interval", "number of points"], ["/cancel"]],
+    "solved": [["edit", "export"], ["/cancel"]],
+    "export": [FORMATS, ["/cancel"]],
+    "edit_options": [["parameters", "initial conditions"], ["time interval", "number of points"], ["solver", "/cancel"]],
     "tutorial": [["Radioactive decay", "Romeo and Juliet"], ["/cancel"]],
 }
 
@@ -59,6 +123,8 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     and return to the start state"""
     logger.info("User %s canceled the conversation.", update.message.from_user.first_name)
 
+    # stop the models being solved, if any
+    solver_scheduler.cancel(update.effective_chat.id)
     # clear user data
     context.user_data.clear()
 
@@ -71,6 +137,82 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return ConversationHandler.END
 
+def update_gauges():
+    """Records the current state of the worker pool, scheduler and cache"""
+    stats.gauge('pool.pending', solver_pool.pending)
+    stats.gauge('scheduler.queued', solver_scheduler.queued)
+    stats.gauge('scheduler.running', solver_scheduler.running)
+    stats.gauge('cache.entries', len(solutions))
+    stats.gauge('cache.size', solutions.size)
+    stats.prune(solver_pool.pids()) # the usage of the workers already replaced
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Marks the session of the user as used, before the update is handled"""
+    if context.user_data is not None:
+        context.user_data.touch()
+
+async def session_expired(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ends the conversation of a user whose session was discarded, as the
+    model it was about is gone"""
+    logger.info("User %s came back after their session expired.", update.message.from_user.first_name)
+
+    await update.message.reply_text(
+        "Your session expired and your model was discarded. What do you want to do now?",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboards["main"], one_time_keyboard=True, resize_keyboard=True
+        ),
+    )
+
+    return ConversationHandler.END
+
+async def forget_expired(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stops treating the user as expired once the update is handled, as
+    any conversation left by the discarded session has been ended by then"""
+    if update.effective_user is not None and update.effective_user.id in expired_users.user_ids:
+        expired_users.remove_user_ids(update.effective_user.id)
+
+async def evict_sessions(app: Application):
+    """Periodically discards the sessions idle for longer than SESSION_TTL, or
+    the least recently used ones over MAX_SESSIONS, along with their
+    conversations, drops the solutions kept by the sessions over SESSION_MEMORY
+    and removes the memory-mapped solutions no longer in use"""
+    while True:
+        await asyncio.sleep(SESSION_INTERVAL)
+        users = set(expired(app.user_data, SESSION_TTL, MAX_SESSIONS))
+        if users:
+            # their conversations are ended when they come back, see session_expired
+            expired_users.add_user_ids(users)
+            for user in users:
+                app.drop_user_data(user)
+            stats.count('session.evicted', len(users))
+            logger.info("Discarded %d idle sessions", len(users))
+        stats.gauge('session.count', len(app.user_data))
+        stats.gauge('session.size', trim(app.user_data, SESSION_MEMORY))
+        await evict_solutions(app)
+
+async def evict_solutions(app: Application):
+    """Removes the oldest memory-mapped solutions over storage.DISK_SIZE,
+    except the ones still held by the cache or the sessions and the ones
+    written by jobs that may still be running"""
+    await load_solver() # storage imports numpy
+    values = solutions.values() + list(warmed.values()) + [s.sol for s in app.user_data.values()]
+    keep = set().union(*(storage.references(v) for v in values))
+    await asyncio.to_thread(storage.evict, keep=keep, min_age=JOB_TIMEOUT)
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Replies with the metrics of the bot, only to its admins"""
+    if update.effective_user.id not in ADMINS:
+        return
+    update_gauges()
+    await update.message.reply_text(f"<pre>{html.escape(stats.report())}</pre>", parse_mode=ParseMode.HTML)
+
+async def dump_stats():
+    """Writes the metrics of the bot to METRICS_FILE periodically"""
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        update_gauges()
+        stats.dump(METRICS_FILE)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message"""
     # Log the error
@@ -88,6 +230,93 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         reply_markup=ReplyKeyboardMarkup([["/cancel"]], one_time_keyboard=True, resize_keyboard=True)
     )
 
+async def run_solver(update: Update, model, name, reply_markup, job=solve_and_plot, *args, previous=None):
+    """Solves and plots the model in the worker pool. Returns the solution and
+    the rendered images, or None when the pool is busy, the chat has too many
+    models being solved or the job timed out after telling the user, or when
+    the user canceled it. The previous solution of the model, if given, is
+    reused by the job when possible"""
+    key = solver.model_key(model, name, job.__name__, *args)
+    result = warmed.get(key)
+    if result is None:
+        result = await solutions.fetch(key)
+    if result is not None:
+        stats.count('cache.hit')
+        return result
+    stats.count('cache.miss')
+
+    if previous is not None:
+        job = functools.partial(job, previous=previous)
+    try:
+        with stats.timer('job.latency'): # waiting in the scheduler and running
+            result = await solver_scheduler.run(update.effective_chat.id, key, job, model, name, *args)
+        await solutions.store(key, result, persist=not storage.references(result)) # mapped files are removed by evict_solutions
+        return result
+    except JobCancelled:
+        stats.count('job.cancelled')
+        logger.info("Job from user %s canceled", update.message.from_user.first_name)
+    except UserBusy:
+        stats.count('job.rejected.user')
+        await update.message.reply_text(
+            "I'm still solving your previous models, please wait for them before solving another one.",
+            reply_markup=reply_markup,
+        )
+    except PoolBusy:
+        stats.count('job.rejected.busy')
+        logger.info("Worker pool busy, rejected job from user %s", update.message.from_user.first_name)
+        await update.message.reply_text(
+            "I'm busy solving other models right now, please try again in a few moments.",
+            reply_markup=reply_markup,
+        )
+    except JobTimeout:
+        logger.info("Job from user %s timed out", update.message.from_user.first_name)
+        await update.message.reply_text(
+            f"Your model took more than {solver_pool.timeout} seconds to solve, so I stopped it. "
+            "Try a shorter time interval or fewer points.",
+            reply_markup=reply_markup,
+        )
+    return None
+
+async def report_stop(update: Update, sol, reply_markup):
+    """Tells the user when the integration of the model stopped early, because
+    the solution blew up or settled at a steady state"""
+    stopped = sol.get('stopped')
+    if stopped == 'diverged':
+        end = f" after t = {sol.t[-1]:.6g}" if len(sol.t) else ""
+        await update.message.reply_text(
+            f"The solution blows up{end}: some unknown grows beyond {solver.DIVERGENCE:.0e}, so I stopped "
+            "solving it there and the plot ends at that point. Check the parameters and initial conditions, "
+            "or try a shorter time interval.",
+            reply_markup=reply_markup,
+        )
+    elif stopped == 'steady':
+        await update.message.reply_text(
+            f"The model settles at a steady state at t = {sol.t_events[1][0]:.6g}, from there on the plot "
+            "follows its decay towards the equilibrium instead of integrating it.",
+            reply_markup=reply_markup,
+        )
+
+async def reply_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, image, reply_markup):
+    """Replies with an image. Images already uploaded are sent by the file_id
+    Telegram returned for them, by the hash of their content, instead of
+    being uploaded again"""
+    file_ids = context.bot_data.setdefault('file_ids', {})
+    key = hashlib.sha256(image).hexdigest()
+
+    if key in file_ids:
+        try:
+            with stats.timer('upload.file_id'):
+                return await update.message.reply_photo(file_ids[key], reply_markup=reply_markup)
+        except BadRequest: # the file_id is no longer valid, upload it again
+            del file_ids[key]
+
+    with stats.timer('upload'):
+        message = await update.message.reply_photo(image, reply_markup=reply_markup)
+    file_ids[key] = message.photo[-1].file_id
+    if len(file_ids) > MAX_FILE_IDS: # forget the oldest one
+        del file_ids[next(iter(file_ids))]
+    return message
+
 
 # -------------------------- CREATE CONVERSATION -------------------------- #
 
@@ -106,27 +335,21 @@ async def create(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def create_variables(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """State of the create conversation.
-    Stores the variables previously submitted by the user in a queue in the user_data dictionary.
-    Then asks the user for the right hand side of the equation of the derivative of the current variable."""
+    Stores the variables previously submitted by the user in the session.
+    Then asks the user for the right hand side of the equation of the derivative of the first variable."""
 
     #logs
     logger.info("User %s submitted variables: %s", update.message.from_user.first_name, update.message.text)
 
-    # store variables in a queue in the user_data dictionary
-    if 'variables' not in context.user_data:
-        # remove spaces
-        v = update.message.text.replace(" ", "")
-        context.user_data['variables'] = deque(v.upper().split(','))
-        context.user_data['variables_ic'] = deque(v.upper().split(',')) # this is a copy of the variables queue that will be used to ask for the initial conditions
-        context.user_data['variables_list'] = v.lower().split(',')
-        current = context.user_data['variables'].popleft()
+    # store variables in the session, without spaces
+    context.user_data.variables = update.message.text.replace(" ", "").split(',')
+    current = context.user_data.variables[0].upper()
 
     msg = f"Enter the right hand side of the equation involving the derivative of {current}\n"
     msg += f"<code>d{current}/dt = ...</code>."
 
-    if 'tutorial' in context.user_data:
-        if context.user_data['tutorial'] == 'rd':
-            msg = context.user_data['msgs'][1] + msg
+    if context.user_data.tutorial == 'rd':
+        msg = rd_tutorial_msgs()[1] + msg
 
     await update.message.reply_text(
         msg,
@@ -137,22 +360,21 @@ async def create_variables(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def create_equation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ State of the create conversation.
-    Stores the equation previously submitted by the user in a list in the user_data dictionary.
-    If there are more variables to process, goes back to the VARIABLES state. Otherwise, 
-    asks the user for the time interval.
+    Stores the equation previously submitted by the user in the session.
+    If there are more variables to process, asks for the equation of the next one.
+    Otherwise, asks the user for the time interval.
     """
 
     #logs
     logger.info("User %s submitted equation: %s", update.message.from_user.first_name, update.message.text)
 
-    # store equation in a list in the user_data dictionary
-    if 'equations' not in context.user_data: # first time in this state
-        context.user_data['equations'] = [update.message.text.lower()]
-    else:
-        context.user_data['equations'].append(update.message.text.lower())
+    # store equation in the session
+    equations = context.user_data.equations
+    variables = context.user_data.variables
+    equations.append(update.message.text.lower())
     
-    if len(context.user_data['variables']) > 0: # there are more variables to process
-        current = context.user_data['variables'].popleft()
+    if len(equations) < len(variables): # there are more variables to process
+        current = variables[len(equations)].upper()
         await update.message.reply_text(
             f"Enter the right hand side of the equation involving the derivative of {current}\n"
             f"<code>d{current}/dt = ...</code>.",
@@ -161,21 +383,19 @@ async def create_equation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return EQUATION
     else: # no more variables to process, ask for time interval
         # format the equations in a string for use in the solver
-        f = ','.join(context.user_data['equations'])
-        v_list = context.user_data['variables_list']
-        # Replace all coincidences of the strings in v_list with the string f with 
-        # "y[i]" where i is the index of the string in v_list
-        for i, v in enumerate(v_list):
+        f = ','.join(equations)
+        # Replace all coincidences of the variables in the string f with 
+        # "y[i]" where i is the index of the variable
+        for i, v in enumerate(variables):
             f = f.replace(v.lower(), f"y[{i}]")
         
-        # store the formatted equations in the user_data dictionary
-        context.user_data['f'] = f
+        # store the formatted equations in the session
+        context.user_data.f = f
 
         msg = "Enter the time interval separated by a comma\n"
         msg += "i.e. <code>0, 10</code>."
-        if 'tutorial' in context.user_data:
-            if context.user_data['tutorial'] == 'rd':
-                msg = context.user_data['msgs'][2] + msg
+        if context.user_data.tutorial == 'rd':
+            msg = rd_tutorial_msgs()[2] + msg
 
         await update.message.reply_text(
             msg,
@@ -183,27 +403,28 @@ async def create_equation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return TS_IC
 
+@needs_solver
 async def create_time_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ State of the create conversation.
-    Stores the time interval previously submitted by the user in the user_data dictionary.
+    Stores the time interval previously submitted by the user in the session.
     Then keeps asking the user for the initial conditions of the variables until there are no more variables.
     """
+    variables = context.user_data.variables
 
-    if 'ts' not in context.user_data: # first time in this state
+    if context.user_data.ts is None: # first time in this state
         #logs
         logger.info("User %s submitted time interval: %s", update.message.from_user.first_name, update.message.text)
 
-        # store time interval in the user_data dictionary
-        context.user_data['ts'] = update.message.text
+        # store time interval in the session
+        context.user_data.ts = update.message.text
 
         # ask for initial conditions
-        current = context.user_data['variables_ic'].popleft()
+        current = variables[0].upper()
 
         msg = f"Enter the initial condition for {current}\n"
         msg += f"<code>{current}(0) = ...</code>."
-        if 'tutorial' in context.user_data:
-            if context.user_data['tutorial'] == 'rd':
-                msg = context.user_data['msgs'][3] + msg
+        if context.user_data.tutorial == 'rd':
+            msg = rd_tutorial_msgs()[3] + msg
         await update.message.reply_text(
             msg,
             parse_mode=ParseMode.HTML,
@@ -216,14 +437,12 @@ async def create_time_interval(update: Update, context: ContextTypes.DEFAULT_TYP
         #logs
         logger.info("User %s submitted initial condition: %s", update.message.from_user.first_name, update.message.text)
 
-        # store initial condition in the user_data dictionary
-        if 'ic' not in context.user_data:
-            context.user_data['ic'] = update.message.text
-        else:
-            context.user_data['ic'] += ',' + update.message.text
+        # store initial condition in the session
+        ic = context.user_data.ic
+        ic.append(update.message.text)
 
-        if len(context.user_data['variables_ic']) > 0: # there are more variables to process
-            current = context.user_data['variables_ic'].popleft()
+        if len(ic) < len(variables): # there are more variables to process
+            current = variables[len(ic)].upper()
             await update.message.reply_text(
                 f"Enter the initial condition for {current}\n"
                 f"<code>{current}(0) = ...</code>.",
@@ -232,9 +451,7 @@ async def create_time_interval(update: Update, context: ContextTypes.DEFAULT_TYP
 
             return TS_IC
         else: 
-            f = context.user_data['f']
-            # store number of points in the user_data dictionary
-            context.user_data['te'] = 1000 # default value, can be changed by the user
+            f = context.user_data.f
 
             # automatically detect parameters in f
             # first get all names using python ast
@@ -250,28 +467,25 @@ async def create_time_interval(update: Update, context: ContextTypes.DEFAULT_TYP
             p = [x for x in p if x not in dir(math)]
             # get all function calls using python ast
             f_calls = [node.func.id for node in ast.walk(ast.parse(f)) if isinstance(node, ast.Call)]
-            print('function calls: ', f_calls)
             # then remove function calls from p
             p = [x for x in p if x not in f_calls]
-            print('parameters', p)
-            # store parameters in a queue in the user_data dictionary
-            context.user_data['p_names'] = deque(p)
-            context.user_data['p_list'] = p
+            stats.event('model.parameters', calls=f_calls, parameters=p)
+            # store parameters in the session
+            context.user_data.p_names = p
 
             # replace all coincidences of the strings in p with the string f with
             # "p[i]" where i is the index of the string in p
             for i, v in enumerate(p):
-                context.user_data['f'] = context.user_data['f'].replace(v.lower(), f"p[{i}]")
+                context.user_data.f = context.user_data.f.replace(v.lower(), f"p[{i}]")
             
             # ask for parameters
             if len(p) > 0:
-                current = context.user_data['p_names'].popleft()
+                current = p[0]
 
                 msg = f"Enter the value of {current}\n"
                 msg += f"<code>{current} = ...</code>."
-                if 'tutorial' in context.user_data:
-                    if context.user_data['tutorial'] == 'rd':
-                        msg = context.user_data['msgs'][5] + msg
+                if context.user_data.tutorial == 'rd':
+                    msg = rd_tutorial_msgs()[5] + msg
                 await update.message.reply_text(
                     msg,
                     parse_mode=ParseMode.HTML,
@@ -280,26 +494,12 @@ async def create_time_interval(update: Update, context: ContextTypes.DEFAULT_TYP
             else:
                 # no parameters to process
                 # create model
-                params = context.user_data['params'] if 'params' in context.user_data else None
-                f = context.user_data['f']
-                ic = context.user_data['ic']
-                ts = context.user_data['ts']
-                te = context.user_data['te']
-                # print
-                print('f', f)
-                print('ic', ic)
-                print('ts', ts)
-                print('te', te)
-                print('params', params)
-                #
-                m = create_model("model", f, ts, ic, t_eval=te, p=params)
-                #store model
-                context.user_data['model'] = m
+                context.user_data.name = "model"
+                build_model(context.user_data)
 
                 msg = "Model created. Do you want to solve and plot the model or edit it first?"
-                if 'tutorial' in context.user_data:
-                    if context.user_data['tutorial'] == 'rd':
-                        msg = context.user_data['msgs'][6] + msg
+                if context.user_data.tutorial == 'rd':
+                    msg = rd_tutorial_msgs()[6] + msg
                 await update.message.reply_text(
                     msg,
                     reply_markup=ReplyKeyboardMarkup(
@@ -308,23 +508,25 @@ async def create_time_interval(update: Update, context: ContextTypes.DEFAULT_TYP
                 )
                 return SOLVE_OR_EDIT
 
+@needs_solver
 async def create_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ State of the create conversation.
-    Stores the parameters previously submitted by the user in the user_data dictionary.
+    Stores the parameters previously submitted by the user in the session.
     Then keeps asking the user for the parameters until there are no more parameters.
     """
 
     #logs
     logger.info("User %s submitted parameter: %s", update.message.from_user.first_name, update.message.text)
 
-    # store parameter in the user_data dictionary
-    if 'params' not in context.user_data:
-        context.user_data['params'] = update.message.text
-    else:
-        context.user_data['params'] += ',' + update.message.text
+    # store parameter in the session
+    if context.user_data.params is None:
+        context.user_data.params = []
+    params = context.user_data.params
+    params.append(update.message.text)
+    p_names = context.user_data.p_names
 
-    if len(context.user_data['p_names']) > 0: # there are more parameters to process
-        current = context.user_data['p_names'].popleft()
+    if len(params) < len(p_names): # there are more parameters to process
+        current = p_names[len(params)]
         await update.message.reply_text(
             f"Enter the value of {current}\n"
             f"<code>{current} = ...</code>.",
@@ -335,21 +537,8 @@ async def create_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else: 
         # no parameters to process
         # create model
-        params = context.user_data['params']
-        f = context.user_data['f']
-        ic = context.user_data['ic']
-        ts = context.user_data['ts']
-        te = context.user_data['te']
-        # print
-        print('f', f)
-        print('ic', ic)
-        print('ts', ts)
-        print('te', te)
-        print('params', params)
-        #
-        m = create_model("model", f, ts, ic, t_eval=te, p=params)
-        #store model
-        context.user_data['model'] = m
+        context.user_data.name = "model"
+        build_model(context.user_data)
 
         await update.message.reply_text(
             "Model created. Do you want to solve and plot the model or edit it first?",
@@ -359,6 +548,7 @@ async def create_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return SOLVE_OR_EDIT
 
+@needs_solver
 async def solve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ State of the create conversation.
     Solves and plots the model previously created by the user.
@@ -366,20 +556,71 @@ async def solve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     #logs
     logger.info("User %s solved the model", update.message.from_user.first_name)
 
-    # solve model
-    sol = solve_model(context.user_data['model'])
+    reply_markup=ReplyKeyboardMarkup(
+            keyboards["solved"], one_time_keyboard=True, resize_keyboard=True, input_field_placeholder="edit, export or cancel"
+    )
+
+    # solve and plot model
+    result = await run_solver(
+        update, context.user_data.model, "model", reply_markup, previous=context.user_data.sol
+    )
+    if context.user_data.name is None: # canceled while solving
+        return ConversationHandler.END
+    if result is None:
+        return SOLVE_OR_EDIT
+    sol, images = result
+    # kept so editing the number of points only resamples it
+    context.user_data.sol = sol
+
+    for image in images:
+        await reply_photo(update, context, image, reply_markup)
+    await report_stop(update, sol, reply_markup)
+    
+    return SOLVE_OR_EDIT
+
+async def export_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ State of the create conversation.
+    Asks the user the format to export the solution in.
+    """
+    #logs
+    logger.info("User %s wants to export the solution", update.message.from_user.first_name)
 
-    # plot model
-    plot_model("model", sol, show=False, save=True)
+    await update.message.reply_text(
+        "Choose the format of the export:\n"
+        "<b>csv</b>: gzip compressed table with a row for every time point.\n"
+        "<b>npz</b>: numpy arrays <code>t</code>, <code>y</code> and <code>names</code>, "
+        "load them with <code>numpy.load</code>.",
+        parse_mode=ParseMode.HTML,
+        reply_markup=ReplyKeyboardMarkup(
+            keyboards["export"], one_time_keyboard=True, resize_keyboard=True
+        ),
+    )
+    return EXPORT
+
+@needs_solver
+async def send_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ State of the create conversation.
+    Exports the solution of the model in the chosen format and sends it as a document.
+    """
+    #logs
+    logger.info("User %s exported the solution as %s", update.message.from_user.first_name, update.message.text)
 
     reply_markup=ReplyKeyboardMarkup(
-            keyboards["edit"], one_time_keyboard=True, resize_keyboard=True, input_field_placeholder="edit or cancel"
+            keyboards["solved"], one_time_keyboard=True, resize_keyboard=True, input_field_placeholder="edit, export or cancel"
     )
 
-    await update.message.reply_photo("model.png", reply_markup=reply_markup)
-    if len(sol.y) == 3:
-        await update.message.reply_photo("model3d.png", reply_markup=reply_markup)
-    
+    fmt = update.message.text
+    names = [v.lower() for v in context.user_data.variables]
+    document = await run_solver(
+        update, context.user_data.model, "model", reply_markup, export_solution, fmt, names,
+        previous=context.user_data.sol
+    )
+    if context.user_data.name is None: # canceled while exporting
+        return ConversationHandler.END
+    if document is not None:
+        with stats.timer('upload.document'):
+            await update.message.reply_document(document, filename=filename("model", fmt), reply_markup=reply_markup)
+
     return SOLVE_OR_EDIT
 
 async def edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -397,6 +638,7 @@ async def edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return EDIT
 
+@needs_solver
 async def input_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ State of the create conversation.
     Asks for the new values of the selected option.
@@ -404,16 +646,25 @@ async def input_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # logs
     logger.info("User %s wants to edit %s", update.message.from_user.first_name, update.message.text)
     
-    context.user_data['edit'] = update.message.text
+    context.user_data.edit = update.message.text
 
     if update.message.text == "initial conditions" or update.message.text == "time interval":
         msg = f"Enter the new {update.message.text} separated by a comma."
     elif update.message.text == "number of points":
         msg = "Enter the number of points to plot"
+    elif update.message.text == "solver":
+        msg = (
+            "Enter the integration method, one of " + ", ".join(solver.METHODS) + ", optionally followed by "
+            "the relative and absolute tolerances separated by a comma\n"
+            "i.e. <code>Radau, 1e-6, 1e-9</code>. Use an implicit method (Radau, BDF or LSODA) for stiff "
+            "systems, or auto to let me choose.\n"
+            "Add <code>jit</code> to compile the equations to machine code, which speeds up long or high "
+            "resolution integrations with RK45, i.e. <code>RK45, 1e-8, 1e-10, jit</code>."
+        )
     else:
-        if 'params' in context.user_data:
+        if context.user_data.params is not None:
             p = ""
-            for i in context.user_data['p_list']:
+            for i in context.user_data.p_names:
                 p += i + ", "
             msg = "Enter the value of the parameters separeted by a comma.\n\n" + p
         else:
@@ -426,10 +677,11 @@ async def input_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return SOLVE_OR_EDIT
     
     await update.message.reply_text(
-        msg
+        msg, parse_mode=ParseMode.HTML
     )
     return EDITED
 
+@needs_solver
 async def edit_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ State of the create conversation.
     Remakes the model with the new values.
@@ -437,33 +689,19 @@ async def edit_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # logs
     logger.info("User %s edited the model", update.message.from_user.first_name)
     
-    if context.user_data['edit'] == "initial conditions":
-        context.user_data['ic'] = update.message.text
-    elif context.user_data['edit'] == "time interval":
-        context.user_data['ts'] = update.message.text
-    elif context.user_data['edit'] == "number of points":
-        context.user_data['te'] = update.message.text
+    if context.user_data.edit == "initial conditions":
+        context.user_data.ic = update.message.text.split(',')
+    elif context.user_data.edit == "time interval":
+        context.user_data.ts = update.message.text
+    elif context.user_data.edit == "number of points":
+        context.user_data.te = update.message.text
+    elif context.user_data.edit == "solver":
+        context.user_data.options = [i.strip() for i in update.message.text.split(',')]
     else:
-        context.user_data['params'] = update.message.text
+        context.user_data.params = update.message.text.split(',')
     
     # create model
-    params = context.user_data['params'] if 'params' in context.user_data else None
-    f = context.user_data['f']
-    ic = context.user_data['ic']
-    ts = context.user_data['ts']
-    te = context.user_data['te']
-    # print
-    print('f', f)
-    print('ic', ic)
-    print('ts', ts)
-    print('te', te)
-    print('params', params)
-    #
-
-    m = create_model("model", f, ts, ic, t_eval=te, p=params)
-
-    #store model
-    context.user_data['model'] = m
+    build_model(context.user_data)
 
     await update.message.reply_text(
         "Model created. Do you want to solve and plot the model or edit it first?",
@@ -474,6 +712,26 @@ async def edit_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return SOLVE_OR_EDIT
 
+async def sweep(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ State of the create conversation.
+    Asks the user for the parameter or initial condition to sweep.
+    """
+    #logs
+    logger.info("User %s wants to sweep the model", update.message.from_user.first_name)
+
+    await update.message.reply_text(sweep_msg(), parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+    return SWEEP
+
+@needs_solver
+async def solve_sweep(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ State of the create conversation.
+    Solves the model for every value of the range and plots the whole ensemble.
+    """
+    await run_sweep(update, context, context.user_data.p_names, context.user_data.variables)
+    if context.user_data.name is None: # canceled while solving
+        return ConversationHandler.END
+    return SOLVE_OR_EDIT
+
 
 # ---------------------------- TUTORIAL ---------------------------- #
 
@@ -498,9 +756,8 @@ async def tutorial_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("User %s chose %s", update.message.from_user.first_name, update.message.text)
 
     if update.message.text == "Radioactive decay":
-        context.user_data['tutorial'] = 'rd'
-        context.user_data['msgs'] = rd_tutorial_msgs()
-        await update.message.reply_text(context.user_data['msgs'][0], parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+        context.user_data.tutorial = 'rd'
+        await update.message.reply_text(rd_tutorial_msgs()[0], parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
     
     return VARIABLES
 
@@ -551,6 +808,7 @@ async def rj(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return SCENARIO
 
+@needs_solver
 async def scenario_ideal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Presents the ideal model"""
     #log
@@ -564,7 +822,7 @@ async def scenario_ideal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     #store model
-    context.user_data['model'] = ideal
+    context.user_data.scenario('ideal')
     
     await update.message.reply_text(
         msg,
@@ -576,6 +834,7 @@ async def scenario_ideal(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return SOLVE_OR_EDIT_TUTORIAL
 
+@needs_solver
 async def scenario_asymmetric(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """presents the asymmetric model"""
     #log
@@ -594,7 +853,7 @@ async def scenario_asymmetric(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
     #store model
-    context.user_data['model'] = asymmetric
+    context.user_data.scenario('asymmetric')
 
     await update.message.reply_text(
         msg,
@@ -606,6 +865,7 @@ async def scenario_asymmetric(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     return SOLVE_OR_EDIT_TUTORIAL
 
+@needs_solver
 async def scenario_spiral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Presents the spiral model"""
     #log
@@ -623,7 +883,7 @@ async def scenario_spiral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     #store model
-    context.user_data['model'] = spiral
+    context.user_data.scenario('spiral')
 
     await update.message.reply_text(
         msg,
@@ -636,23 +896,30 @@ async def scenario_spiral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return SOLVE_OR_EDIT_TUTORIAL
 
 
+@needs_solver
 async def solve_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Solve the current model"""
     #logs
     logger.info("User %s solved the model", update.message.from_user.first_name)
 
-    #solve model
-    sol = solve_model(context.user_data['model'])
-
-    #plot model
-    name = context.user_data['model'].name
-    plot_model(name, sol, show=False, save=True)
-
     reply_markup=ReplyKeyboardMarkup(
             keyboards["edit"], one_time_keyboard=True, resize_keyboard=True, input_field_placeholder="edit or cancel"
     )
 
-    await update.message.reply_photo(name + ".png", reply_markup=reply_markup)
+    #solve and plot model
+    name = context.user_data.name
+    result = await run_solver(
+        update, context.user_data.model, name, reply_markup, previous=context.user_data.sol
+    )
+    if context.user_data.name is None: # canceled while solving
+        return ConversationHandler.END
+    if result is None:
+        return SOLVE_OR_EDIT_TUTORIAL
+    sol, images = result
+    context.user_data.sol = sol
+
+    await reply_photo(update, context, images[0], reply_markup)
+    await report_stop(update, sol, reply_markup)
 
     return SOLVE_OR_EDIT_TUTORIAL
 
@@ -667,13 +934,30 @@ async def edit_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     return INPUT_IC_TUTORIAL
+
+async def sweep_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the parameter or initial condition to sweep"""
+    #logs
+    logger.info("User %s wants to sweep the model", update.message.from_user.first_name)
+
+    await update.message.reply_text(sweep_msg(), parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
+    return SWEEP_TUTORIAL
+
+@needs_solver
+async def solve_sweep_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Solves the current model for every value of the range"""
+    await run_sweep(update, context, solver.love_params, ['J', 'R'])
+    if context.user_data.name is None: # canceled while solving
+        return ConversationHandler.END
+    return SOLVE_OR_EDIT_TUTORIAL
+
+@needs_solver
 async def edit_ic_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Modifies the initial conditions of the model"""
 
     #create new model
-    old = context.user_data['model']
-    m = create_model(old.name, love_func, old.t_span, update.message.text, t_eval=old.t_eval, p=old.p)
-    context.user_data['model'] = m
+    context.user_data.ic = update.message.text.split(',')
+    context.user_data.build()
 
     await update.message.reply_text(
         "Listo!",
@@ -686,6 +970,49 @@ async def edit_ic_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # utils
+def build_model(session):
+    """ Creates the model of a session from the source entered by the user """
+    params = ','.join(session.params) if session.params is not None else None
+    stats.event('model.created', f=session.f, ic=','.join(session.ic), ts=session.ts, te=session.te, params=params)
+    return session.build()
+
+def sweep_msg():
+    """ Returns the message asking for the range of a sweep """
+    return (
+        "Enter the name of the parameter or variable (for its initial condition) to sweep, "
+        "followed by the first value, the last value and the number of values, separated by a comma\n"
+        f"i.e. <code>k, 0.1, 1, 50</code>. At most {MAX_SWEEP} values are allowed."
+    )
+
+async def run_sweep(update: Update, context: ContextTypes.DEFAULT_TYPE, p_names, variables):
+    """ Parses the range of a sweep, then solves and plots the ensemble """
+    #logs
+    logger.info("User %s submitted sweep: %s", update.message.from_user.first_name, update.message.text)
+
+    reply_markup = ReplyKeyboardMarkup(
+        keyboards["solve_or_edit"], one_time_keyboard=True, resize_keyboard=True
+    )
+
+    name, start, stop, num = [i.strip() for i in update.message.text.split(',')]
+    start, stop, num = float(start), float(stop), int(num)
+    if name.lower() in [i.lower() for i in p_names]:
+        target, index = 'p', [i.lower() for i in p_names].index(name.lower())
+    elif name.lower() in [i.lower() for i in variables]:
+        target, index = 'ic', [i.lower() for i in variables].index(name.lower())
+        name += '(0)'
+    else:
+        raise ValueError(f"{name} is neither a parameter nor a variable of the model.")
+    if not 1 < num <= MAX_SWEEP:
+        raise ValueError(f"The number of values must be between 2 and {MAX_SWEEP}.")
+
+    model = context.user_data.model
+    result = await run_solver(
+        update, model, model.name, reply_markup, sweep_and_plot, target, index, [start, stop, num], name
+    )
+    if result is not None:
+        await reply_photo(update, context, result[1][0], reply_markup)
+        await report_stop(update, result[0], reply_markup)
+
 def rd_tutorial_msgs():
     """ Returns a list of messages for the tutorial """
     msgs = []
@@ -742,52 +1069,145 @@ def rd_tutorial_msgs():
 #  MAIN APPLICATION  #
 # ------------------ #
 
-def main():
-    """Run bot."""
-    app = Application.builder().token(TOKEN).read_timeout(30).write_timeout(30).build()
-
+def warmup_models():
+    """Returns the models every user of the tutorials solves, with the name
+    their plots are titled with: the Romeo and Juliet scenarios and the
+    radioactive decay model as the tutorial has it entered"""
+    decay = solver.create_model("model", "-p[0] * y[0]", "0, 10", "100", t_eval=1000, p="0.5")
+    scenarios = [getattr(solver, name) for name in ("ideal", "asymmetric", "spiral")]
+    return [(model, model.name) for model in scenarios] + [(decay, "model")]
+
+async def warm_up(app: Application):
+    """Solves and plots the tutorial models in the worker pool, one at a time
+    so the first users are not kept waiting behind them, and uploads their
+    plots to WARMUP_CHAT_ID, if set, so they are sent by file_id"""
+    await load_solver()
+    file_ids = app.bot_data.setdefault('file_ids', {})
+    for model, name in warmup_models():
+        key = solver.model_key(model, name, solve_and_plot.__name__)
+        try:
+            with stats.timer('warmup'): # users asking for it meanwhile wait for the same job
+                warmed[key] = await solver_scheduler.run(None, key, solve_and_plot, model, name)
+        except Exception: # the bot works without it, only slower
+            logger.exception("Warm-up of %s failed", name)
+            continue
+
+        if WARMUP_CHAT_ID is None:
+            continue
+        for image in warmed[key][1]:
+            image_key = hashlib.sha256(image).hexdigest()
+            if image_key in file_ids:
+                continue
+            try:
+                message = await app.bot.send_photo(WARMUP_CHAT_ID, image, disable_notification=True)
+            except TelegramError:
+                logger.exception("Upload of the warm-up plot of %s failed", name)
+                break
+            file_ids[image_key] = message.photo[-1].file_id
+    logger.info("Warm-up done, %d models ready", len(warmed))
+
+async def post_init(app: Application):
+    """Starts loading the numeric stack, followed by the warm-up of the
+    tutorial models if enabled, the eviction of idle sessions and the
+    periodic dump of the metrics"""
+    task = asyncio.create_task(warm_up(app)) if WARMUP else load_solver()
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    background_tasks.add(asyncio.create_task(evict_sessions(app)))
+    if METRICS_FILE is not None:
+        background_tasks.add(asyncio.create_task(dump_stats()))
+
+async def shutdown(app: Application):
+    """Stops the worker processes when the bot stops"""
+    solver_pool.shutdown()
+    if METRICS_FILE is not None:
+        update_gauges()
+        stats.dump(METRICS_FILE)
+
+def add_handlers(app: Application):
+    """Adds the handlers of the bot to an application"""
     # define handlers
     start_handler = CommandHandler("start", start)
     tutorial_handler = CommandHandler("tutorial", tutorial)
+    stats_handler = CommandHandler("stats", show_stats)
+    # the conversations are persisted along with the sessions, if enabled
+    persistent = app.persistence is not None
+    # checked first in every state, for the users whose session was discarded meanwhile
+    expired_handler = MessageHandler(expired_users, session_expired)
 
     create_handler = ConversationHandler(
         entry_points=[
             CommandHandler("create", create),
             MessageHandler(filters.Regex(r"^Radioactive decay$"), tutorial_choice)
             ],
-        states={
+        states={state: [expired_handler] + handlers for state, handlers in {
             VARIABLES: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_variables)],
             EQUATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_equation)],
             TS_IC: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_time_interval)],
             PARAMETERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_parameters)],
-            SOLVE_OR_EDIT: [MessageHandler(filters.Regex(r"^solve$"), solve), MessageHandler(filters.Regex(r"^edit$"), edit)],
-            EDIT: [MessageHandler(filters.Regex(r"^parameters$|^initial conditions$|^time interval$|^number of points$"), input_edit)],
+            SOLVE_OR_EDIT: [MessageHandler(filters.Regex(r"^solve$"), solve, block=False), MessageHandler(filters.Regex(r"^edit$"), edit), MessageHandler(filters.Regex(r"^sweep$"), sweep), MessageHandler(filters.Regex(r"^export$"), export_format)],
+            EDIT: [MessageHandler(filters.Regex(r"^parameters$|^initial conditions$|^time interval$|^number of points$|^solver$"), input_edit)],
             EDITED: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_model)],
-        },
+            SWEEP: [MessageHandler(filters.TEXT & ~filters.COMMAND, solve_sweep, block=False)],
+            EXPORT: [MessageHandler(filters.Regex("^(" + "|".join(FORMATS) + ")$"), send_export, block=False)],
+            # while a model is being solved
+            ConversationHandler.WAITING: [CommandHandler("cancel", cancel)],
+        }.items()},
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="create",
+        persistent=persistent,
     )
 
     rj_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex(r"^Romeo and Juliet$"), rj)],
-        states={
+        states={state: [expired_handler] + handlers for state, handlers in {
             SCENARIO: [MessageHandler(filters.Regex(r"^Relación ideal$"), scenario_ideal), MessageHandler(filters.Regex(r"^Relación asimétrica$"), scenario_asymmetric), MessageHandler(filters.Regex(r"^Relación espiral$"), scenario_spiral)],
-            SOLVE_OR_EDIT_TUTORIAL: [MessageHandler(filters.Regex(r"^solve$"), solve_tutorial), MessageHandler(filters.Regex(r"^edit$"), edit_tutorial)],
-            INPUT_IC_TUTORIAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_ic_tutorial)]
-        },
+            SOLVE_OR_EDIT_TUTORIAL: [MessageHandler(filters.Regex(r"^solve$"), solve_tutorial, block=False), MessageHandler(filters.Regex(r"^edit$"), edit_tutorial), MessageHandler(filters.Regex(r"^sweep$"), sweep_tutorial)],
+            INPUT_IC_TUTORIAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_ic_tutorial)],
+            SWEEP_TUTORIAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, solve_sweep_tutorial, block=False)],
+            ConversationHandler.WAITING: [CommandHandler("cancel", cancel)],
+        }.items()},
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="rj",
+        persistent=persistent,
     )
 
 
     # add handlers
+    app.add_handler(TypeHandler(Update, touch_session), group=-1)
     app.add_handler(start_handler)
     app.add_handler(create_handler)
     app.add_handler(rj_handler)
     app.add_handler(tutorial_handler)
+    app.add_handler(stats_handler)
+    app.add_handler(TypeHandler(Update, forget_expired), group=1)
     app.add_error_handler(error_handler)
 
+def main():
+    """Run bot."""
+    builder = (
+        Application.builder().token(TOKEN).post_init(post_init).post_shutdown(shutdown).context_types(context_types)
+        .application_class(chat_ordered_application, {'handling': CONCURRENT_UPDATES})
+        .concurrent_updates(UPDATE_BACKLOG)
+        .connection_pool_size(CONNECTION_POOL_SIZE)
+        .connect_timeout(CONNECT_TIMEOUT).read_timeout(READ_TIMEOUT).write_timeout(WRITE_TIMEOUT).pool_timeout(POOL_TIMEOUT)
+    )
+    if BASE_URL is not None: # i.e. a local Bot API server
+        builder = builder.base_url(BASE_URL)
+    if SESSION_FILE is not None:
+        builder = builder.persistence(sqlite_persistence(SESSION_FILE, SESSION_TTL, SESSION_INTERVAL))
+    app = builder.build()
+    add_handlers(app)
 
     # start the bot (ctrl-c to stop)
-    app.run_polling()
+    if WEBHOOK_URL is None:
+        app.run_polling(poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT)
+    else:
+        # Telegram posts the updates to WEBHOOK_URL, forwarded by a reverse proxy to the local listener
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH, webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_CONNECTIONS,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,355 @@
+"""Benchmark of the pipeline of the bot: creating, solving and plotting a
+corpus of models at several numbers of points, and the conversations of the
+bot end to end against a fake Telegram server, alone and with many chats
+at once.
+
+    python benchmark.py --output report.json
+    python benchmark.py --baseline report.json
+
+The report is a JSON file with the minimum and median seconds of every
+measurement. Given a baseline report, the measurements slower than it by
+more than the tolerance are listed, and the exit code is 1 if there are any.
+The exit code is also 1 if importing the bot takes longer than its budget
+or imports the numeric stack, which must only be loaded once it started,
+if the compiled equations do not follow the float64 semantics of NumPy, or
+if a plot already sent is uploaded again instead of sent by its file_id.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import scipy
+import matplotlib
+
+from solver import create_model, solve_model, plot_model, love_func
+from equations import rhs
+
+# models of the benchmark: name, equations, time span, initial conditions and
+# keyword arguments of create_model
+CORPUS = [
+    ('ideal', love_func, '0, 1', '5, 17',
+     {'p': '0.9,0.9,0.9,0.9,0.8,0.8,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1'}),
+    ('asymmetric', love_func, '0, 5', '3, 8',
+     {'p': '0.9,0.3,0.3,0.8,0.3,0.8,0.8,0.9,0.8,0.8,0.3,0.8,0.2,0.8'}),
+    ('spiral', love_func, '0, 15', '10, 2',
+     {'p': '0.126,0.98,0.98,0.126,0.126,0.64,0.5,0.5,0.5,0.5,0.1,0.64,0.95,0.95'}),
+    ('radioactive decay', '-p[0] * y[0]', '0, 10', '100', {'p': '0.5'}),
+    ('lorenz', 'p[0] * (y[1] - y[0]), y[0] * (p[1] - y[2]) - y[1], y[0] * y[1] - p[2] * y[2]',
+     '0, 40', '1, 1, 1', {'p': '10, 28, 8/3'}),
+    ('robertson', '-0.04 * y[0] + 1e4 * y[1] * y[2], 0.04 * y[0] - 1e4 * y[1] * y[2] - 3e7 * y[1]**2, 3e7 * y[1]**2',
+     '0, 1e5', '1, 0, 0', {'method': 'auto'}),
+    # Lorenz 96, 20 unknowns coupled with their neighbours
+    ('lorenz 96', ', '.join(f'(y[{(i + 1) % 20}] - y[{i - 2}]) * y[{i - 1}] - y[{i}] + p[0]' for i in range(20)),
+     '0, 20', ', '.join(['8.01'] + ['8'] * 19), {'p': '8'}),
+]
+# equations, state and derivatives expected from the compiled equations, which
+# must follow the float64 semantics of NumPy whether they are vectorized or not
+SEMANTICS = [
+    ('1/y[0]', [0.0], [np.inf]),
+    ('y[0]**400', [10.0], [np.inf]),
+    ('(y[0] - 1)**(1/3)', [0.0], [np.nan]),
+    ('y[0]**0.5', [-1.0], [np.nan]),
+    ('y[-1], y[0]', [1.0, 2.0], [2.0, 1.0]),
+]
+SIZES = [1000, 10000, 100000]
+IMPORT_BUDGET = 0.5 # seconds importing the bot can take
+CHATS = 50          # chats sending their updates at once in the ingestion benchmark
+LATENCY = 0.02      # seconds the fake Telegram server takes to answer in the ingestion benchmark
+# updates of every chat in the ingestion benchmark, none of them solves a model
+INGESTION = ['/start', '/create', 'N', '-k * N', '0, 10', '/cancel']
+HEAVY_MODULES = ['numpy', 'scipy', 'matplotlib', 'PIL'] # modules the bot must not import when it starts
+
+# conversations of the end to end benchmark, as the texts sent by the user
+CONVERSATIONS = {
+    'radioactive decay': ['/create', 'N', '-k * N', '0, 10', '100', '0.5', 'solve',
+                          'edit', 'number of points', '5000', 'solve', '/cancel'],
+    'lorenz': ['/create', 'u, v, w', '10 * (v - u)', 'u * (28 - w) - v', 'u * v - 8/3 * w', '0, 40',
+               '1', '1', '1', 'solve', '/cancel'],
+    'romeo and juliet': ['Romeo and Juliet', 'Relación ideal', 'solve', '/cancel'],
+}
+
+
+def measure(fn, repeat):
+    """Returns the minimum and median seconds of repeat calls to fn, and its
+    last value"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times)}, value
+
+def bench_pipeline(repeat, sizes, only=None):
+    """Times create_model, solve_model and plot_model for every model of the
+    corpus and number of points"""
+    results = {}
+    for name, f, t_span, ic, kwargs in CORPUS:
+        if only and name not in only:
+            continue
+        for te in sizes:
+            results[f'create/{name}/{te}'], m = measure(lambda: create_model(name, f, t_span, ic, t_eval=te, **kwargs), repeat)
+            results[f'solve/{name}/{te}'], sol = measure(lambda: solve_model(m), repeat)
+            results[f'plot/{name}/{te}'], _ = measure(lambda: plot_model(name, sol), repeat)
+            print(f"{name:>18} {te:>7}  create {results[f'create/{name}/{te}']['min']:.4f}  "
+                  f"solve {results[f'solve/{name}/{te}']['min']:.4f}  plot {results[f'plot/{name}/{te}']['min']:.4f}")
+    return results
+
+def check_semantics():
+    """Evaluates the equations of SEMANTICS one system at a time and as an
+    ensemble, and returns the ones whose derivatives are not the expected
+    ones, with the derivatives or the error"""
+    wrong = []
+    for f, y, expected in SEMANTICS:
+        system = rhs(f.split(', '))
+        with np.errstate(all='ignore'):
+            for label, evaluate in [('single', lambda: system.bind()(0, np.array(y))),
+                                    ('ensemble', lambda: system.vectorized()(0, np.array(y)[:, None])[:, 0])]:
+                try:
+                    value = evaluate()
+                except Exception as e:
+                    value = repr(e)
+                if isinstance(value, str) or not np.array_equal(value, expected, equal_nan=True):
+                    wrong.append((f, label, value))
+    return wrong
+
+def bench_import(repeat):
+    """Times the import of the bot in a fresh interpreter, as the cumulative
+    time -X importtime reports for it, and returns the heavy modules it
+    imported along with the measurement"""
+    script = 'import sys, bde_bot; print(" ".join(m for m in %r if m in sys.modules))' % HEAVY_MODULES
+    times, heavy = [], []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        )
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2] == ' bde_bot': # not indented, imported by the script itself
+                times.append(int(fields[1]) / 1e6)
+        heavy = process.stdout.split()
+    print(f"{'import bde_bot':>18} {min(times):.4f}" + (f"  imports {', '.join(heavy)}" if heavy else ''))
+    return {'import/bde_bot': {'min': min(times), 'median': statistics.median(times)}}, heavy
+
+
+class fake_telegram:
+    """Telegram Bot API answering every request of the bot locally, used as
+    the request backend of the application"""
+    def __init__(self, latency=0):
+        from telegram.request import BaseRequest
+
+        server = self
+        self.latency = latency
+        self.messages = 0
+        self.uploaded = 0
+
+        class request(BaseRequest):
+            async def initialize(self):
+                pass
+
+            async def shutdown(self):
+                pass
+
+            async def do_request(self, url, method, request_data=None, *args, **kwargs):
+                if server.latency:
+                    await asyncio.sleep(server.latency)
+                return 200, json.dumps({'ok': True, 'result': server.answer(url, request_data)}).encode()
+
+        self.request = request()
+
+    def answer(self, url, request_data):
+        endpoint = url.rsplit('/', 1)[-1]
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot',
+                    'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if endpoint == 'deleteWebhook':
+            return True
+
+        self.messages += 1
+        params = request_data.parameters if request_data is not None else {}
+        message = {'message_id': self.messages, 'date': 0, 'chat': {'id': params.get('chat_id', 0), 'type': 'private'}}
+        if endpoint == 'sendPhoto':
+            if request_data.contains_files:
+                self.uploaded += 1
+            message['photo'] = [{'file_id': f'photo{self.messages}', 'file_unique_id': f'photo{self.messages}',
+                                 'width': 640, 'height': 480}]
+        elif endpoint == 'sendDocument':
+            message['document'] = {'file_id': f'doc{self.messages}', 'file_unique_id': f'doc{self.messages}'}
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+async def run_conversations(repeat):
+    """Drives the conversations of the bot through its handlers, with every
+    update answered by a fake Telegram server. Returns the measurements and
+    the conversations that uploaded again plots already sent, which must be
+    sent by their file_id"""
+    from telegram import Update
+    from telegram.ext import Application
+    import bde_bot
+
+    server = fake_telegram()
+    app = Application.builder().token('0:benchmark').request(server.request).context_types(bde_bot.context_types).build()
+    bde_bot.add_handlers(app)
+    await app.initialize()
+    await app.start()
+
+    results, update_id, uploaded = {}, 0, []
+    for name, texts in CONVERSATIONS.items():
+        for run in ('cold', 'warm'): # without and with the solutions already cached
+            if run == 'cold':
+                bde_bot.solutions.clear()
+                app.bot_data.clear()
+            before = server.uploaded
+            times = []
+            for _ in range(repeat if run == 'warm' else 1):
+                start = time.perf_counter()
+                for text in texts:
+                    update_id += 1
+                    running = asyncio.all_tasks()
+                    await app.process_update(Update.de_json(message_update(update_id, 1, text), app.bot))
+                    # waits for the handlers that do not block the application
+                    await asyncio.gather(*(asyncio.all_tasks() - running))
+                times.append(time.perf_counter() - start)
+            results[f'conversation/{name}/{run}'] = {'min': min(times), 'median': statistics.median(times)}
+            print(f"{name:>18} {run:>7}  {min(times):.4f}")
+            if run == 'warm' and server.uploaded > before:
+                uploaded.append(name)
+
+    await app.stop()
+    await app.shutdown()
+    bde_bot.solver_pool.shutdown()
+    return results, uploaded
+
+def message_update(update_id, chat, text):
+    """Returns the JSON of the update of a text message of a private chat"""
+    message = {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': chat, 'type': 'private'},
+        'from': {'id': chat, 'is_bot': False, 'first_name': 'benchmark'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+async def run_ingestion(repeat, chats):
+    """Feeds the updates of many chats at once through the update queue, as
+    polling or the webhook do, with a fake Telegram server as slow as the
+    real one, handling them one at a time and concurrently"""
+    from telegram import Update
+    from telegram.ext import Application
+    import bde_bot
+    from updates import chat_ordered_application
+
+    results = {}
+    for mode, handling in (('sequential', 1), ('concurrent', bde_bot.CONCURRENT_UPDATES)):
+        server = fake_telegram(LATENCY)
+        app = (
+            Application.builder().token('0:benchmark').request(server.request).context_types(bde_bot.context_types)
+            .application_class(chat_ordered_application, {'handling': handling})
+            .concurrent_updates(bde_bot.UPDATE_BACKLOG).build()
+        )
+        bde_bot.add_handlers(app)
+        await app.initialize()
+        await app.start()
+        times = []
+        for _ in range(repeat):
+            updates = [
+                Update.de_json(message_update(len(INGESTION) * chat + i, chat, text), app.bot)
+                for i, text in enumerate(INGESTION) for chat in range(1, chats + 1)
+            ]
+            start = time.perf_counter()
+            for update in updates:
+                await app.update_queue.put(update)
+            await app.update_queue.join()
+            times.append(time.perf_counter() - start)
+        await app.stop()
+        await app.shutdown()
+        results[f'ingestion/{mode}'] = {'min': min(times), 'median': statistics.median(times)}
+        print(f"{'ingestion':>18} {mode:>10}  {min(times):.4f}  {len(updates) / min(times):.0f} updates/s")
+    return results
+
+def compare(report, baseline, tolerance):
+    """Returns the measurements of the report slower than the baseline by more
+    than the tolerance, as (name, baseline seconds, report seconds)"""
+    slower = []
+    for name, value in report['results'].items():
+        if name in baseline['results']:
+            before = baseline['results'][name]['min']
+            if value['min'] > before * (1 + tolerance):
+                slower.append((name, before, value['min']))
+    return slower
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+        'numpy': np.__version__, 'scipy': scipy.__version__, 'matplotlib': matplotlib.__version__,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='file where the JSON report is written')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown over the baseline, 0.1 is 10%%')
+    parser.add_argument('--repeat', type=int, default=3, help='calls of every measurement')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of points')
+    parser.add_argument('--only', nargs='+', help='names of the models of the corpus to benchmark')
+    parser.add_argument('--no-conversations', action='store_true', help='skip the end to end benchmark')
+    parser.add_argument('--chats', type=int, default=CHATS, help='chats sending updates at once in the ingestion benchmark')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET, help='seconds importing the bot can take')
+    args = parser.parse_args()
+
+    # first, as the import of the bot is measured in a fresh interpreter anyway
+    results, heavy = bench_import(args.repeat)
+    report = {'meta': metadata(), 'results': results}
+    report['results'].update(bench_pipeline(args.repeat, args.sizes, args.only))
+    uploaded = []
+    if not args.no_conversations:
+        conversations, uploaded = asyncio.run(run_conversations(args.repeat))
+        report['results'].update(conversations)
+        report['results'].update(asyncio.run(run_ingestion(args.repeat, args.chats)))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    failed = False
+    startup = report['results']['import/bde_bot']['min']
+    if startup > args.import_budget:
+        print(f'import of bde_bot took {startup:.4f} s, over its budget of {args.import_budget:.4f} s')
+        failed = True
+    if heavy:
+        print(f"bde_bot imports {', '.join(heavy)} when it starts")
+        failed = True
+
+    for name in uploaded:
+        print(f'{name} uploaded its plots again instead of sending their file_id')
+        failed = True
+    for f, label, value in check_semantics():
+        print(f'{f} ({label}) gives {value}, not the float64 result')
+        failed = True
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = compare(report, json.load(file), args.tolerance)
+        for name, before, after in slower:
+            print(f'slower: {name} {before:.4f} -> {after:.4f} ({after / before - 1:+.0%})')
+        failed = failed or bool(slower)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import os
+import pickle
+import asyncio
+import threading
+from collections import OrderedDict
+
+# returned by the reads of entries that are not persisted, as None can be a value
+_missing = object()
+
+
+def sizeof(value):
+    """Estimates the memory used by a cached value, counting only its arrays
+    and images as they dominate the size of the solutions"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if hasattr(value, 'nbytes'): # numpy arrays, without importing numpy
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value)
+    if hasattr(value, '__dict__'): # i.e. the dense output of a solution
+        return sizeof(vars(value))
+    return 0
+
+
+class solution_cache:
+    """Least recently used cache of solutions and rendered images, bounded
+    by the total size of the stored values. Optionally, every entry is also
+    pickled to a directory so the cache survives restarts."""
+    def __init__(self, max_size=256 * 2**20, path=None, max_disk_size=1024 * 2**20):
+        """Initializes the solution_cache class
+        Parameters
+        ----------
+        max_size : int, optional
+            Maximum size in bytes of the values kept in memory. The default
+            is 256 MiB.
+        path : str, optional
+            Directory where the entries are persisted. The default is None,
+            which keeps the cache only in memory.
+        max_disk_size : int, optional
+            Maximum size in bytes of the persisted entries. The default is
+            1 GiB.
+        """
+        self.max_size = max_size
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.path is not None and os.path.exists(self._file(key)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key, default=None):
+        """Returns the value stored with key, or default if there is none"""
+        if key in self._entries or self.path is None:
+            return self._get(key, default)
+        return self._loaded(key, self._load(key), default)
+
+    async def fetch(self, key, default=None):
+        """Same as get, but reads the persisted entries in a thread so the
+        event loop is not blocked"""
+        if key in self._entries or self.path is None:
+            return self._get(key, default)
+        return self._loaded(key, await asyncio.to_thread(self._load, key), default)
+
+    def put(self, key, value, persist=True):
+        """Stores value with key, evicting the least recently used entries if
+        the cache is over its size. Values that do not outlive the process,
+        i.e. the ones referencing memory-mapped files, are not persisted"""
+        self._store(key, value)
+        if self.path is not None and persist:
+            self._dump(key, value)
+
+    async def store(self, key, value, persist=True):
+        """Same as put, but writes the persisted entry in a thread so the
+        event loop is not blocked"""
+        self._store(key, value)
+        if self.path is not None and persist:
+            await asyncio.to_thread(self._dump, key, value)
+
+    def _get(self, key, default):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        self.misses += 1
+        return default
+
+    def _loaded(self, key, value, default):
+        if value is _missing:
+            self.misses += 1
+            return default
+        self._store(key, value)
+        self.hits += 1
+        return value
+
+    def _load(self, key):
+        """Reads a persisted entry, only touching the disk so it can run in
+        any thread, or returns _missing if there is none"""
+        try:
+            with open(self._file(key), 'rb') as file:
+                value = pickle.load(file)
+            os.utime(self._file(key)) # keeps the disk eviction order as lru
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return _missing
+        return value
+
+    def _dump(self, key, value):
+        """Persists an entry, only touching the disk so it can run in any thread"""
+        tmp = f'{self._file(key)}.{os.getpid()}.{threading.get_ident()}.tmp' # writers of the same key do not clash
+        with open(tmp, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._file(key))
+        self._evict_disk()
+
+    def _store(self, key, value):
+        size = sizeof(value)
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if size > self.max_size: # would evict everything else and still not fit
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.path):
+            try:
+                info = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError: # removed by another thread meanwhile
+                continue
+            if name.endswith('.pkl'):
+                files.append((info.st_mtime, info.st_size, os.path.join(self.path, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, f in sorted(files):
+            if total <= self.max_disk_size:
+                break
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def values(self):
+        """Returns the values kept in memory"""
+        return [value for value, _ in self._entries.values()]
+
+    def clear(self):
+        """Removes every entry kept in memory"""
+        self._entries.clear()
+        self.size = 0
@@ -1 +1,56 @@
-TOKEN = ""
\ No newline at end of file
+TOKEN = ""
+BASE_URL = None    # url of the Bot API server, None uses the official one
+ADMINS = []        # ids of the users allowed to see the metrics of the bot with /stats
+
+# how the updates are received
+WEBHOOK_URL = None          # public https url Telegram posts the updates to, i.e. 'https://example.com/bot', None uses polling
+WEBHOOK_LISTEN = '127.0.0.1' # address of the local http listener, behind a reverse proxy terminating https
+WEBHOOK_PORT = 8443         # port of the local http listener
+WEBHOOK_PATH = 'bot'        # path of the updates in the local http listener, i.e. the one of WEBHOOK_URL
+WEBHOOK_SECRET = None       # token Telegram sends with every update, the rest are rejected, None disables it
+WEBHOOK_CONNECTIONS = 40    # connections Telegram opens at once to deliver the updates
+POLL_TIMEOUT = 10           # seconds every long poll waits for new updates
+POLL_INTERVAL = 0.0         # seconds between polls
+
+# updates of different chats are handled concurrently, the ones of every chat in order
+CONCURRENT_UPDATES = 64     # updates handled at once
+UPDATE_BACKLOG = 1024       # updates taken from the queue at once, handled or waiting for an earlier one of their chat
+
+# requests to the Bot API
+CONNECTION_POOL_SIZE = 256  # connections open at once
+CONNECT_TIMEOUT = 5         # seconds to connect
+READ_TIMEOUT = 30           # seconds to receive the response
+WRITE_TIMEOUT = 30          # seconds to send the request, uploads included
+POOL_TIMEOUT = 10           # seconds to wait for a free connection
+
+# metrics of the bot, see metrics.py
+METRICS_FILE = None     # JSON file where the metrics are dumped, None disables it
+METRICS_INTERVAL = 60   # seconds between dumps
+
+# worker pool used to solve and plot the models
+WORKERS = None      # number of worker processes, None uses every core
+QUEUE_SIZE = 32     # number of jobs allowed to wait for a free worker
+JOB_TIMEOUT = 60    # seconds a job can run before its worker is killed
+USER_JOBS = 2       # number of jobs every chat can have queued or running
+
+# warm-up of the tutorial models when the bot starts
+WARMUP = True           # whether to solve and plot them before anyone asks, False disables it
+WARMUP_CHAT_ID = None   # chat where their plots are uploaded to get their file_ids, None skips the upload
+
+# cache of solutions and plots
+CACHE_SIZE = 256 * 2**20        # bytes kept in memory
+CACHE_DIR = None                # directory to persist the cache, None keeps it in memory only
+CACHE_DISK_SIZE = 1024 * 2**20  # bytes kept on disk
+
+# sessions of the users, see session.py
+SESSION_FILE = None             # SQLite database where the sessions are persisted, None keeps them in memory only
+SESSION_TTL = 7 * 24 * 3600     # seconds a session can be idle before it is discarded
+MAX_SESSIONS = 10000            # sessions kept, the least recently used are discarded first
+SESSION_MEMORY = 256 * 2**20    # bytes of the last solutions kept by the sessions to resample them
+SESSION_INTERVAL = 60           # seconds between evictions, and between writes to SESSION_FILE
+
+# file_ids of the plots already uploaded to Telegram, by the hash of the image
+MAX_FILE_IDS = 10000
+
+# largest number of members of a parameter or initial condition sweep
+MAX_SWEEP = 500
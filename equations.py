@@ -0,0 +1,539 @@
+import ast
+import collections
+import copy
+import functools
+import hashlib
+import math
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+# names the user is allowed to reference inside an equation
+VARIABLES = ('t', 'y', 'p')
+MATH_NAMES = {name: getattr(math, name) for name in dir(math) if not name.startswith('_')}
+BUILTIN_NAMES = {'abs': abs, 'min': min, 'max': max, 'pow': pow}
+
+def _log(x, base=None):
+    return np.log(x) if base is None else np.log(x) / np.log(base)
+
+def _reduce(ufunc):
+    return lambda *args: functools.reduce(ufunc, args)
+
+# element-wise equivalents used when the equations are evaluated on arrays,
+# functions without one are vectorized
+NUMPY_NAMES = dict(
+    {name: np.vectorize(value) if callable(value) else value for name, value in MATH_NAMES.items()},
+    sin=np.sin, cos=np.cos, tan=np.tan, asin=np.arcsin, acos=np.arccos, atan=np.arctan,
+    atan2=np.arctan2, sinh=np.sinh, cosh=np.cosh, tanh=np.tanh, asinh=np.arcsinh,
+    acosh=np.arccosh, atanh=np.arctanh, exp=np.exp, expm1=np.expm1, log=_log,
+    log2=np.log2, log10=np.log10, log1p=np.log1p, sqrt=np.sqrt, pow=np.power,
+    fabs=np.fabs, floor=np.floor, ceil=np.ceil, trunc=np.trunc, hypot=np.hypot,
+    copysign=np.copysign, fmod=np.fmod, degrees=np.degrees, radians=np.radians,
+    abs=np.abs, min=_reduce(np.minimum), max=_reduce(np.maximum),
+)
+
+def _stack(values, y):
+    """Stacks the derivatives of every unknown, broadcasting the ones that do
+    not depend on the unknowns to the shape of the ensemble"""
+    return np.stack([np.broadcast_to(v, y.shape[1:]) for v in values])
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load,
+    ast.Constant, ast.Subscript,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv,
+    ast.UAdd, ast.USub,
+)
+
+
+def split_equations(f):
+    """Splits a string of comma separated equations into the right hand side
+    of each one
+    Parameters
+    ----------
+    f : str
+        Equations separated by a comma. Each one can be given either as the
+        right hand side alone or as ``name = rhs``.
+    Returns
+    -------
+    list
+        List containing the source of the right hand side of each equation.
+    """
+    functions = []
+    depth = 0
+    current = ''
+    for c in f:
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        if c == ',' and depth == 0: # only split on top level commas
+            functions.append(current)
+            current = ''
+        else:
+            current += c
+    functions.append(current)
+
+    return [func.split('=')[1].strip() if '=' in func else func.strip() for func in functions]
+
+def _index(node):
+    """Returns the integer index of a subscript node or None if it is not a constant integer"""
+    try:
+        i = ast.literal_eval(node.slice)
+    except ValueError:
+        return None
+    return i if type(i) is int else None
+
+def parse_equation(source, n, n_params):
+    """Parses and validates the right hand side of an equation
+    Parameters
+    ----------
+    source : str
+        Source of the right hand side of the equation.
+    n : int
+        Number of unknowns of the system.
+    n_params : int
+        Number of parameters of the system.
+    Returns
+    -------
+    ast.AST
+        Body of the parsed expression.
+    """
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        raise ValueError(f'Invalid equation: {source}')
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in VARIABLES and node.id not in MATH_NAMES and node.id not in BUILTIN_NAMES:
+                raise ValueError(f'Unknown name {node.id} in equation: {source}')
+        elif isinstance(node, ast.Subscript):
+            if not isinstance(node.value, ast.Name) or node.value.id not in ('y', 'p'):
+                raise ValueError(f'Only y and p can be indexed in equation: {source}')
+            i = _index(node)
+            size = n if node.value.id == 'y' else n_params
+            if i is None or not -size <= i < size:
+                raise ValueError(f'Invalid index {node.value.id}[{ast.unparse(node.slice)}] in equation: {source}')
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.keywords:
+                raise ValueError(f'Invalid function call in equation: {source}')
+            if not callable(MATH_NAMES.get(node.func.id, BUILTIN_NAMES.get(node.func.id))):
+                raise ValueError(f'Unknown function {node.func.id} in equation: {source}')
+        elif isinstance(node, ast.Constant):
+            if type(node.value) not in (int, float):
+                raise ValueError(f'Invalid constant {node.value!r} in equation: {source}')
+        elif not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f'Invalid expression {type(node).__name__} in equation: {source}')
+
+    return tree.body
+
+def _varying(node):
+    """Returns whether an expression depends on t or y or not"""
+    return any(isinstance(n, ast.Name) and n.id in ('t', 'y') for n in ast.walk(node))
+
+def _children(node):
+    """Yields the fields of a node holding subexpressions, skipping the names
+    of the called functions and the indices of the subscripts"""
+    for field, value in ast.iter_fields(node):
+        if (isinstance(node, ast.Call) and field == 'func') or (isinstance(node, ast.Subscript) and field == 'slice'):
+            continue
+        if isinstance(value, ast.expr) or (isinstance(value, list) and all(isinstance(v, ast.expr) for v in value)):
+            yield field, value
+
+def _replace(node, field, value, visit):
+    setattr(node, field, [visit(v) for v in value] if isinstance(value, list) else visit(value))
+
+def _fold(node, constants):
+    """Replaces the largest subexpressions of node that do not depend on t nor
+    y by the names of constants, adding them to constants"""
+    if not _varying(node):
+        if isinstance(node, ast.Constant):
+            return node
+        key = ast.dump(node)
+        if key not in constants:
+            constants[key] = ('_c' + str(len(constants)), node)
+        return ast.Name(id=constants[key][0], ctx=ast.Load())
+    for field, value in _children(node):
+        _replace(node, field, value, lambda child: _fold(child, constants))
+    return node
+
+def _unpack(node, n):
+    """Replaces every y[i] in node by the name _yi"""
+    if isinstance(node, ast.Subscript) and node.value.id == 'y':
+        return ast.Name(id='_y' + str(_index(node) % n), ctx=ast.Load())
+    for field, value in _children(node):
+        _replace(node, field, value, lambda child: _unpack(child, n))
+    return node
+
+def _compound(node):
+    return isinstance(node, (ast.BinOp, ast.Call)) or (
+        isinstance(node, ast.UnaryOp) and isinstance(node.operand, (ast.BinOp, ast.Call))
+    )
+
+def _eliminate(exprs, temps):
+    """Replaces the subexpressions repeated in exprs by the names of
+    temporaries, adding their assignments to temps in evaluation order"""
+    counts = collections.Counter(ast.dump(node) for e in exprs for node in ast.walk(e) if _compound(node))
+    names = {}
+
+    def visit(node):
+        if not _compound(node):
+            return node
+        key = ast.dump(node)
+        if key in names:
+            return ast.Name(id=names[key], ctx=ast.Load())
+        for field, value in _children(node):
+            _replace(node, field, value, visit)
+        if counts[key] > 1:
+            names[key] = '_s' + str(len(names))
+            temps.append((names[key], node))
+            return ast.Name(id=names[key], ctx=ast.Load())
+        return node
+
+    return [visit(e) for e in exprs]
+
+def compile_equations(exprs, n=None, vectorized=False):
+    """Compiles a list of parsed expressions into a single function. The
+    subexpressions that only depend on the parameters are hoisted out and
+    evaluated once, when the parameters are bound, and the subexpressions
+    repeated across the equations are evaluated once per call.
+    Parameters
+    ----------
+    exprs : list
+        List of parsed expressions.
+    n : int, optional
+        Number of unknowns of the system. The default is None, which takes
+        one unknown for each expression.
+    vectorized : bool, optional
+        Whether to compile the function for an ensemble of systems or not.
+        Then y has shape (n, m) and every p can be either a scalar or an
+        array of shape (m,), one value for each member of the ensemble. The
+        default is False.
+    Returns
+    -------
+    function
+        Function bind(*p) returning the function f(t, y) that evaluates the
+        expressions as a NumPy array for those parameters. y must be a 
+        NumPy array.
+    """
+    n = len(exprs) if n is None else n
+    # parsed again so no node is shared between expressions
+    exprs = [ast.parse(ast.unparse(e), mode='eval').body for e in exprs]
+
+    constants, temps = {}, []
+    exprs = [_unpack(_fold(e, constants), n) for e in exprs]
+    exprs = _eliminate(exprs, temps)
+
+    lines = ['def bind(*p):']
+    lines += ['    ' + name + ' = ' + ast.unparse(node) for name, node in constants.values()]
+    lines += ['    def f(t, y):']
+    if n > 0:
+        lines += ['        ' + ''.join('_y' + str(i) + ', ' for i in range(n)) + '= y'] # numpy scalars, so the results follow the float64 semantics of the arrays
+    lines += ['        ' + name + ' = ' + ast.unparse(node) for name, node in temps]
+    values = '(' + ''.join(ast.unparse(e) + ', ' for e in exprs) + ')'
+    lines += ['        return ' + ('_stack(' + values + ', y)' if vectorized else '_array(' + values + ')')]
+    lines += ['    return f']
+
+    if vectorized:
+        namespace = dict(NUMPY_NAMES, _stack=_stack, __builtins__={})
+    else:
+        namespace = dict(MATH_NAMES, **BUILTIN_NAMES, _array=np.array, __builtins__={})
+    exec(compile('\n'.join(lines), '<equations>', 'exec'), namespace)
+    return namespace['bind']
+
+
+class NotDifferentiable(Exception):
+    """Raised when an equation can not be differentiated symbolically"""
+
+
+def _const(value):
+    return ast.Constant(value=value)
+
+def _is_const(node, value=None):
+    return isinstance(node, ast.Constant) and (value is None or node.value == value)
+
+def _add(a, b):
+    if _is_const(a, 0):
+        return b
+    if _is_const(b, 0):
+        return a
+    if _is_const(a) and _is_const(b):
+        return _const(a.value + b.value)
+    return ast.BinOp(left=a, op=ast.Add(), right=b)
+
+def _neg(a):
+    if _is_const(a):
+        return _const(-a.value)
+    return ast.UnaryOp(op=ast.USub(), operand=a)
+
+def _sub(a, b):
+    if _is_const(b, 0):
+        return a
+    if _is_const(a, 0):
+        return _neg(b)
+    if _is_const(a) and _is_const(b):
+        return _const(a.value - b.value)
+    return ast.BinOp(left=a, op=ast.Sub(), right=b)
+
+def _mul(a, b):
+    if _is_const(a, 0) or _is_const(b, 0):
+        return _const(0)
+    if _is_const(a, 1):
+        return b
+    if _is_const(b, 1):
+        return a
+    if _is_const(a) and _is_const(b):
+        return _const(a.value * b.value)
+    return ast.BinOp(left=a, op=ast.Mult(), right=b)
+
+def _div(a, b):
+    if _is_const(a, 0):
+        return _const(0)
+    if _is_const(b, 1):
+        return a
+    return ast.BinOp(left=a, op=ast.Div(), right=b)
+
+def _pow(a, b):
+    if _is_const(b, 1):
+        return a
+    return ast.BinOp(left=a, op=ast.Pow(), right=b)
+
+def _call(name, *args):
+    return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=list(args), keywords=[])
+
+def _y_index(node, n):
+    """Returns the index of the unknown referenced by a node or None if it does not reference one"""
+    if isinstance(node, ast.Subscript) and node.value.id == 'y':
+        return _index(node) % n
+    return None
+
+def depends(expr, j, n):
+    """Returns whether an expression depends on the unknown y[j] or not"""
+    return any(_y_index(node, n) == j for node in ast.walk(expr))
+
+# derivative of the functions of one argument, as a function of the argument
+DERIVATIVES = {
+    'sin': lambda a: _call('cos', a),
+    'cos': lambda a: _neg(_call('sin', a)),
+    'tan': lambda a: _div(_const(1), _pow(_call('cos', a), _const(2))),
+    'asin': lambda a: _div(_const(1), _call('sqrt', _sub(_const(1), _pow(a, _const(2))))),
+    'acos': lambda a: _div(_const(-1), _call('sqrt', _sub(_const(1), _pow(a, _const(2))))),
+    'atan': lambda a: _div(_const(1), _add(_const(1), _pow(a, _const(2)))),
+    'sinh': lambda a: _call('cosh', a),
+    'cosh': lambda a: _call('sinh', a),
+    'tanh': lambda a: _sub(_const(1), _pow(_call('tanh', a), _const(2))),
+    'asinh': lambda a: _div(_const(1), _call('sqrt', _add(_pow(a, _const(2)), _const(1)))),
+    'acosh': lambda a: _div(_const(1), _call('sqrt', _sub(_pow(a, _const(2)), _const(1)))),
+    'atanh': lambda a: _div(_const(1), _sub(_const(1), _pow(a, _const(2)))),
+    'exp': lambda a: _call('exp', a),
+    'expm1': lambda a: _call('exp', a),
+    'log': lambda a: _div(_const(1), a),
+    'log2': lambda a: _div(_const(1), _mul(a, _call('log', _const(2)))),
+    'log10': lambda a: _div(_const(1), _mul(a, _call('log', _const(10)))),
+    'log1p': lambda a: _div(_const(1), _add(_const(1), a)),
+    'sqrt': lambda a: _div(_const(0.5), _call('sqrt', a)),
+    'fabs': lambda a: _call('copysign', _const(1.0), a),
+    'abs': lambda a: _call('copysign', _const(1.0), a),
+    'floor': lambda a: _const(0),
+    'ceil': lambda a: _const(0),
+    'trunc': lambda a: _const(0),
+    'degrees': lambda a: _const(180 / math.pi),
+    'radians': lambda a: _const(math.pi / 180),
+}
+
+def differentiate(expr, j, n):
+    """Differentiates an expression with respect to an unknown
+    Parameters
+    ----------
+    expr : ast.AST
+        Parsed expression.
+    j : int
+        Index of the unknown.
+    n : int
+        Number of unknowns of the system.
+    Returns
+    -------
+    ast.AST
+        Parsed expression of the derivative, simplified where it is trivial.
+    """
+    if not depends(expr, j, n):
+        return _const(0)
+    if isinstance(expr, ast.Subscript):
+        return _const(1)
+
+    d = lambda node: differentiate(node, j, n)
+    if isinstance(expr, ast.UnaryOp):
+        return _neg(d(expr.operand)) if isinstance(expr.op, ast.USub) else d(expr.operand)
+
+    if isinstance(expr, ast.BinOp):
+        a, b = expr.left, expr.right
+        if isinstance(expr.op, ast.Add):
+            return _add(d(a), d(b))
+        if isinstance(expr.op, ast.Sub):
+            return _sub(d(a), d(b))
+        if isinstance(expr.op, ast.Mult):
+            return _add(_mul(d(a), b), _mul(a, d(b)))
+        if isinstance(expr.op, ast.Div):
+            return _sub(_div(d(a), b), _div(_mul(a, d(b)), _pow(b, _const(2))))
+        if isinstance(expr.op, ast.Pow):
+            if depends(b, j, n): # a ** b * (b' log(a) + b a' / a)
+                return _mul(expr, _add(_mul(d(b), _call('log', a)), _div(_mul(b, d(a)), a)))
+            return _mul(_mul(b, _pow(a, _sub(b, _const(1)))), d(a))
+        if isinstance(expr.op, ast.Mod): # a % b = a - b * floor(a / b)
+            return _sub(d(a), _mul(_call('floor', _div(a, b)), d(b)))
+        if isinstance(expr.op, ast.FloorDiv):
+            return _const(0)
+
+    if isinstance(expr, ast.Call):
+        name, args = expr.func.id, expr.args
+        if name == 'pow' and len(args) == 2:
+            return differentiate(_pow(args[0], args[1]), j, n)
+        if name == 'log' and len(args) == 2:
+            return differentiate(_div(_call('log', args[0]), _call('log', args[1])), j, n)
+        if name == 'atan2' and len(args) == 2:
+            a, b = args
+            return _div(_sub(_mul(b, d(a)), _mul(a, d(b))), _add(_pow(a, _const(2)), _pow(b, _const(2))))
+        if name == 'hypot':
+            return _div(functools.reduce(_add, [_mul(a, d(a)) for a in args]), expr)
+        if name in DERIVATIVES and len(args) == 1:
+            return _mul(DERIVATIVES[name](args[0]), d(args[0]))
+
+    raise NotDifferentiable(f'Can not differentiate {ast.unparse(expr)}')
+
+def sparsity(exprs):
+    """Returns the sparsity pattern of the Jacobian of a system of equations,
+    as a boolean array of shape (n, n)"""
+    n = len(exprs)
+    return np.array([[depends(expr, j, n) for j in range(n)] for expr in exprs], dtype=bool).reshape(n, n)
+
+def affine(node):
+    """Returns whether an expression is an affine function of the unknowns
+    with constant coefficients, a[0] * y[0] + ... + a[n - 1] * y[n - 1] + b
+    where neither a nor b depend on t or y, or not"""
+    if not _varying(node):
+        return True
+    if isinstance(node, ast.Subscript):
+        return node.value.id == 'y'
+    if isinstance(node, ast.UnaryOp):
+        return affine(node.operand)
+    if isinstance(node, ast.BinOp):
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            return affine(node.left) and affine(node.right)
+        if isinstance(node.op, ast.Mult):
+            return (not _varying(node.left) and affine(node.right)) or (not _varying(node.right) and affine(node.left))
+        if isinstance(node.op, ast.Div):
+            return not _varying(node.right) and affine(node.left)
+    return False
+
+def compile_jacobian(exprs):
+    """Compiles the Jacobian of a system of equations, only evaluating the
+    entries that are not zero
+    Parameters
+    ----------
+    exprs : list
+        List of parsed expressions, one for each unknown of the system.
+    Returns
+    -------
+    function
+        Function bind(*p) returning the function jac(t, y) that evaluates the
+        Jacobian for those parameters, either as a dense array or, for large
+        and sparse systems, as a sparse matrix.
+    """
+    n = len(exprs)
+    pattern = sparsity(exprs)
+    rows, cols = np.nonzero(pattern)
+    entries = [differentiate(copy.deepcopy(exprs[i]), j, n) for i, j in zip(rows, cols)]
+    bind_values = compile_equations(entries, n)
+
+    def bind(*p):
+        values = bind_values(*p)
+        if n >= 20 and pattern.mean() < 0.2:
+            def jac(t, y):
+                return csc_matrix((values(t, y), (rows, cols)), shape=(n, n))
+        else:
+            def jac(t, y):
+                J = np.zeros((n, n))
+                J[rows, cols] = values(t, y)
+                return J
+        return jac
+    return bind
+
+
+class rhs:
+    """Right hand side of a system of ODEs compiled from its source equations.
+    Instances are callable as f(t, y, *p), though binding the parameters once
+    with bind is faster, and can be pickled, as only the source of the 
+    equations is stored."""
+    def __init__(self, functions, n_params=0):
+        """Initializes the rhs class
+        Parameters
+        ----------
+        functions : list
+            List containing the source of the right hand side of each equation.
+        n_params : int, optional
+            Number of parameters of the system. The default is 0.
+        """
+        self.functions = list(functions)
+        self.n_params = n_params
+        self.exprs = [parse_equation(func, len(self.functions), n_params) for func in self.functions]
+        self._bind = compile_equations(self.exprs)
+        # canonical hash of the parsed equations, independent of formatting
+        self.key = hashlib.sha256('\n'.join(ast.dump(e) for e in self.exprs).encode()).hexdigest()
+
+    def __call__(self, t, y, *p):
+        return self._bind(*p)(t, np.asarray(y))
+
+    def bind(self, *p):
+        """Returns the function f(t, y) of the system for the parameters p,
+        with the subexpressions that only depend on them already evaluated"""
+        return self._bind(*p)
+
+    def bind_jac(self, *p):
+        """Returns the function jac(t, y) returning the Jacobian of the system
+        for the parameters p, or None if some equation is not differentiable"""
+        return self._jac(*p) if self._jac is not None else None
+
+    @functools.cached_property
+    def sparsity(self):
+        """Boolean array of shape (n, n), whether the derivative of every
+        unknown depends on every unknown or not"""
+        return sparsity(self.exprs)
+
+    @property
+    def differentiable(self):
+        """Whether the Jacobian of the system can be derived symbolically or not"""
+        return self._jac is not None
+
+    @functools.cached_property
+    def _jac(self):
+        try:
+            return compile_jacobian(self.exprs)
+        except NotDifferentiable:
+            return None
+
+    @functools.cached_property
+    def linear(self):
+        """Whether the system is linear with constant coefficients, 
+        y' = A y + b, or not"""
+        return all(affine(expr) for expr in self.exprs)
+
+    @functools.cached_property
+    def autonomous(self):
+        """Whether the equations do not depend on t, so a state where the
+        derivatives vanish stays there, or not"""
+        return not any(isinstance(n, ast.Name) and n.id == 't' for e in self.exprs for n in ast.walk(e))
+
+    @functools.cached_property
+    def vectorized(self):
+        """Function bind(*p) returning the function f(t, y) that evaluates an
+        ensemble of systems at once, see compile_equations"""
+        return compile_equations(self.exprs, vectorized=True)
+
+    def __len__(self):
+        return len(self.functions)
+
+    def __getstate__(self):
+        return {'functions': self.functions, 'n_params': self.n_params}
+
+    def __setstate__(self, state):
+        self.__init__(state['functions'], state['n_params'])
@@ -0,0 +1,85 @@
+import io
+import gzip
+import zipfile
+
+from lazy import lazy_module
+
+# only the workers export, so numpy is imported when they first do
+np = lazy_module('numpy')
+
+FORMATS = ['csv', 'npz']
+CHUNK = 2**16 # rows written at once, bounds the memory used besides the output
+LEVEL = 1     # gzip compression level, higher ones take several times longer for a few percent less
+
+def write_csv(sol, file, names=None, chunk=CHUNK):
+    """Writes a solution as gzip compressed CSV, one row per time point
+    Parameters
+    ----------
+    sol : OdeResult
+        Solution to write.
+    file : file object
+        Binary file where the compressed CSV is written.
+    names : list, optional
+        Names of the unknowns, used in the header. The default is None, which
+        names them y0, y1, ...
+    chunk : int, optional
+        Number of rows formatted at once. The default is CHUNK.
+    """
+    n = len(sol.y)
+    names = names if names is not None else ['y' + str(i) for i in range(n)]
+    row = ','.join(['%.12g'] * (n + 1)) + '\n'
+
+    with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=LEVEL, mtime=0) as gz:
+        gz.write((','.join(['t'] + list(names)) + '\n').encode())
+        for start in range(0, len(sol.t), chunk):
+            block = np.column_stack([sol.t[start:start + chunk], sol.y[:, start:start + chunk].T])
+            gz.write(((row * len(block)) % tuple(block.ravel())).encode())
+
+def write_npz(sol, file, names=None):
+    """Writes a solution as a compressed NPZ archive with the arrays t, y, of
+    shape (unknowns, points), and names. The arrays are compressed as they
+    are written instead of being copied whole into the archive
+    Parameters
+    ----------
+    sol : OdeResult
+        Solution to write.
+    file : file object
+        Binary file where the archive is written.
+    names : list, optional
+        Names of the unknowns. The default is None, which names them y0, y1, ...
+    """
+    names = names if names is not None else ['y' + str(i) for i in range(len(sol.y))]
+    arrays = {'t': np.asarray(sol.t), 'y': np.asarray(sol.y), 'names': np.array(names)}
+
+    with zipfile.ZipFile(file, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=LEVEL) as archive:
+        for key, array in arrays.items():
+            with archive.open(key + '.npy', mode='w', force_zip64=True) as member:
+                np.lib.format.write_array(member, array, allow_pickle=False)
+
+def export(sol, fmt='csv', names=None):
+    """Exports a solution into an in-memory document
+    Parameters
+    ----------
+    sol : OdeResult
+        Solution to export.
+    fmt : str, optional
+        Format of the document, one of FORMATS. The default is 'csv'.
+    names : list, optional
+        Names of the unknowns. The default is None.
+    Returns
+    -------
+    bytes
+        Compressed document.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('The format must be one of ' + ', '.join(FORMATS) + '.')
+    buf = io.BytesIO()
+    if fmt == 'csv':
+        write_csv(sol, buf, names)
+    else:
+        write_npz(sol, buf, names)
+    return buf.getvalue()
+
+def filename(name, fmt):
+    """Returns the name of the document of an export"""
+    return name + ('.csv.gz' if fmt == 'csv' else '.npz')
@@ -0,0 +1,346 @@
+import ast
+import copy
+import hashlib
+import importlib.util
+import logging
+import os
+import stat
+import sys
+import tempfile
+
+import numpy as np
+from scipy.integrate import RK45
+from scipy.optimize import OptimizeResult
+
+logger = logging.getLogger(__name__)
+
+# directory where the generated modules are written, numba caches the machine
+# code next to them so it is compiled only once per system of equations. The
+# modules in it are run, so it is private to the user running the bot.
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'odebot-jit-' + str(os.getuid() if hasattr(os, 'getuid') else 0))
+
+_compiled = {} # modules already loaded in this process, by hash of the equations
+
+HEADER = '''from math import *
+import numpy as np
+from numba import njit
+
+_C = np.array({C!r})
+_A = np.array({A!r})
+_B = np.array({B!r})
+_E = np.array({E!r})
+_P = np.array({P!r})
+'''.format(**{name: getattr(RK45, name).tolist() for name in 'CABEP'})
+
+# explicit Runge-Kutta method of order 5(4) of Dormand and Prince, the same
+# steps, error control and dense output as scipy's RK45 but without leaving
+# machine code between the evaluations of the equations
+INTEGRATOR = '''
+@njit(cache=True)
+def _norm(x):
+    return np.sqrt(np.mean(x * x))
+
+@njit(cache=True)
+def integrate(t0, t1, y0, p, t_eval, rtol, atol, max_nfev, steady, limit):
+    n = y0.size
+    y = y0.copy()
+    f = np.empty(n)
+    rhs(t0, y, p, f)
+
+    scale = atol + np.abs(y) * rtol
+    d0, d1 = _norm(y / scale), _norm(f / scale)
+    h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+    h0 = min(h0, t1 - t0)
+    f1 = np.empty(n)
+    rhs(t0 + h0, y + h0 * f, p, f1)
+    nfev = 2
+    d2 = _norm((f1 - f) / scale) / h0
+    h1 = max(1e-6, h0 * 1e-3) if d1 <= 1e-15 and d2 <= 1e-15 else (0.01 / max(d1, d2)) ** 0.2
+    h_abs = min(100 * h0, h1, t1 - t0)
+
+    capacity = 256
+    ts = np.empty(capacity + 1)
+    ys = np.empty((capacity, n))
+    Qs = np.empty((capacity, n, 4))
+    ts[0] = t0
+    out = np.empty((n, t_eval.size))
+    K = np.empty((7, n))
+    tmp = np.empty(n)
+    y_new = np.empty(n)
+
+    t, steps, j, status = t0, 0, 0, 0
+    while t < t1:
+        min_step = 10 * abs(np.nextafter(t, np.inf) - t)
+        h_abs = max(h_abs, min_step)
+        accepted, rejected = False, False
+        while not accepted:
+            if h_abs < min_step:
+                status = -1
+                break
+            t_new = min(t + h_abs, t1)
+            h = t_new - t
+            h_abs = abs(h)
+
+            K[0] = f
+            for s in range(1, 6):
+                for i in range(n):
+                    acc = 0.0
+                    for k in range(s):
+                        acc += _A[s, k] * K[k, i]
+                    tmp[i] = y[i] + h * acc
+                rhs(t + _C[s] * h, tmp, p, K[s])
+            for i in range(n):
+                acc = 0.0
+                for k in range(6):
+                    acc += _B[k] * K[k, i]
+                y_new[i] = y[i] + h * acc
+            rhs(t_new, y_new, p, K[6])
+            nfev += 6
+
+            err = 0.0
+            for i in range(n):
+                acc = 0.0
+                for k in range(7):
+                    acc += _E[k] * K[k, i]
+                err += (acc * h / (atol + max(abs(y[i]), abs(y_new[i])) * rtol)) ** 2
+            error_norm = np.sqrt(err / n)
+            if error_norm < 1:
+                factor = 10.0 if error_norm == 0 else min(10.0, 0.9 * error_norm ** -0.2)
+                if rejected:
+                    factor = min(1.0, factor)
+                h_abs *= factor
+                accepted = True
+            else:
+                h_abs *= max(0.2, 0.9 * error_norm ** -0.2)
+                rejected = True
+        if status != 0:
+            break
+
+        if steps == capacity:
+            capacity *= 2
+            ts = np.concatenate((ts, np.empty(capacity - steps)))
+            ys = np.concatenate((ys, np.empty((capacity - steps, n))))
+            Qs = np.concatenate((Qs, np.empty((capacity - steps, n, 4))))
+        for i in range(n):
+            for k in range(4):
+                acc = 0.0
+                for s in range(7):
+                    acc += K[s, i] * _P[s, k]
+                Qs[steps, i, k] = acc
+        ys[steps] = y
+        ts[steps + 1] = t_new
+
+        while j < t_eval.size and t_eval[j] <= t_new:
+            x = (t_eval[j] - t) / h
+            for i in range(n):
+                q = Qs[steps, i]
+                out[i, j] = y[i] + h * x * (q[0] + x * (q[1] + x * (q[2] + x * q[3])))
+            j += 1
+
+        steps += 1
+        t = t_new
+        y[:] = y_new
+        f[:] = K[6]
+        if limit > 0:
+            for i in range(n):
+                if not abs(y[i]) <= limit: # also when it is nan
+                    status = 4
+            if status != 0:
+                break
+        if steady > 0:
+            settled = True
+            for i in range(n):
+                if abs(f[i]) * steady >= atol + abs(y[i]) * rtol:
+                    settled = False
+                    break
+            if settled:
+                status = 3
+                break
+        if max_nfev > 0 and nfev > max_nfev:
+            status = 2
+            break
+
+    return out[:, :j], ts[:steps + 1], ys[:steps], Qs[:steps], nfev, status
+'''
+
+
+def available():
+    """Whether numba is installed or not"""
+    return importlib.util.find_spec('numba') is not None
+
+def _native(expr):
+    """Rewrites the calls numba can not compile into equivalent ones"""
+    class rewrite(ast.NodeTransformer):
+        def visit_Call(self, node):
+            self.generic_visit(node)
+            if isinstance(node.func, ast.Name) and node.func.id == 'log' and len(node.args) == 2:
+                x, base = node.args
+                return ast.BinOp(
+                    ast.Call(ast.Name('log', ast.Load()), [x], []), ast.Div(),
+                    ast.Call(ast.Name('log', ast.Load()), [base], []),
+                )
+            return node
+    return ast.fix_missing_locations(rewrite().visit(copy.deepcopy(expr)))
+
+def source(exprs):
+    """Generates the source of the module compiling a system of equations
+    Parameters
+    ----------
+    exprs : list
+        Parsed right hand side of every equation, see equations.parse_equation.
+    Returns
+    -------
+    str
+        Source of a module defining rhs(t, y, p, dy), which writes the
+        derivatives in dy, and integrate, the integrator of the system.
+    """
+    body = ''.join(f'    dy[{i}] = {ast.unparse(_native(e))}\n' for i, e in enumerate(exprs))
+    return HEADER + '\n@njit(cache=True)\ndef rhs(t, y, p, dy):\n' + body + INTEGRATOR
+
+def compile_rhs(f):
+    """Compiles the equations of a system to machine code, once per process
+    and, through the cache of numba, once per system of equations
+    Parameters
+    ----------
+    f : rhs
+        Right hand side of the system.
+    Returns
+    -------
+    module
+        Generated module, see source, or None if numba is not installed or
+        can not compile some of the functions used in the equations.
+    """
+    if f.key in _compiled:
+        return _compiled[f.key]
+
+    module = None
+    if available() and private_dir(CACHE_DIR):
+        code = source(f.exprs)
+        # named after the source, so changes to the integrator do not load stale modules
+        name = 'rhs_' + hashlib.sha256(code.encode()).hexdigest()
+        path = os.path.join(CACHE_DIR, name + '.py')
+        if not os.path.exists(path): # rewriting it would invalidate the cached machine code
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as file:
+                file.write(code)
+            os.replace(tmp, path)
+
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        # numba only loads the cached machine code of modules it can import by name
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        try: # compiles for the types used by solve, or loads the cached machine code
+            module.integrate.compile('(f8, f8, f8[::1], f8[::1], f8[::1], f8, f8, i8, f8, f8)')
+        except Exception: # numba.TypingError, i.e. a math function it does not support
+            module = None
+
+    _compiled[f.key] = module
+    return module
+
+def private_dir(path):
+    """Creates a directory only accessible to the current user, and returns
+    whether it is, as the modules generated in it are imported and run. A
+    directory created beforehand by another user, or writable by others, is
+    not used
+    Parameters
+    ----------
+    path : str
+        Path of the directory.
+    Returns
+    -------
+    bool
+        Whether the directory is private.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    owner = os.getuid() if hasattr(os, 'getuid') else info.st_uid
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != owner or info.st_mode & 0o077:
+        logger.warning('%s is not private to this user, the jit backend is disabled', path)
+        return False
+    return True
+
+class dense_output:
+    """Piecewise polynomial interpolating the steps of the compiled integrator.
+    Callable as the dense output of solve_ivp."""
+    def __init__(self, ts, ys, Qs):
+        """Initializes the dense_output class
+        Parameters
+        ----------
+        ts : array_like
+            Times of the steps, of shape (steps + 1,).
+        ys : array_like
+            Solution at the start of every step, of shape (steps, n).
+        Qs : array_like
+            Coefficients of the polynomial of every step, of shape (steps, n, 4).
+        """
+        self.ts, self.ys, self.Qs = ts, ys, Qs
+        self.t_min, self.t_max = ts[0], ts[-1]
+
+    def __call__(self, t):
+        """Evaluates the solution at t, a scalar or an array of times"""
+        tau = np.atleast_1d(np.asarray(t, dtype=float))
+        k = np.clip(np.searchsorted(self.ts, tau, side='right') - 1, 0, len(self.ys) - 1)
+        h = self.ts[k + 1] - self.ts[k]
+        x = (tau - self.ts[k]) / h
+        powers = np.cumprod(np.repeat(x[:, None], 4, axis=1), axis=1)
+        y = self.ys[k] + h[:, None] * np.einsum('kij,kj->ki', self.Qs[k], powers)
+        return y[0] if np.ndim(t) == 0 else y.T
+
+def solve(model, t_eval, max_nfev=0, steady=0.0, limit=0.0, t_span=None, y0=None):
+    """Solves a model with the compiled RK45 integrator
+    Parameters
+    ----------
+    model : model
+        Model to solve.
+    t_eval : array_like
+        Times at which the solution is stored.
+    max_nfev : int, optional
+        Evaluations of the equations after which the integration is stopped,
+        0 for no limit. The default is 0.
+    steady : float, optional
+        Time scale of the steady state check: the integration stops once
+        the derivatives would change the state by less than the tolerances
+        over it, 0 to never stop. The default is 0.
+    limit : float, optional
+        Absolute value of the unknowns above which the solution diverged
+        and the integration stops, 0 for no limit. The default is 0.
+    t_span : 2-tuple, optional
+        Time span to integrate. The default is None, which uses the time
+        span of the model.
+    y0 : array_like, optional
+        State at the start of t_span. The default is None, which uses the
+        initial conditions of the model.
+    Returns
+    -------
+    OdeResult
+        Solution of the model with dense output, like the one of solve_ivp,
+        or None if the equations can not be compiled or the integration
+        exceeded max_nfev. Stopping at a divergence or a steady state is
+        reported as the first or second terminal event of solve_ivp.
+    """
+    module = compile_rhs(model.f)
+    if module is None:
+        return None
+
+    t0, t1 = (float(i) for i in (model.t_span if t_span is None else t_span))
+    y, ts, ys, Qs, nfev, status = module.integrate(
+        t0, t1, np.asarray(model.initial_conditions if y0 is None else y0, dtype=float), np.asarray(model.p or [], dtype=float),
+        np.asarray(t_eval, dtype=float), float(model.rtol), float(model.atol), max_nfev, float(steady), float(limit),
+    )
+    if status == 2:
+        return None
+
+    dense = dense_output(ts, ys, Qs)
+    n = len(model.initial_conditions)
+    t_events = [np.array([ts[-1]] if status == code else []) for code in (4, 3)]
+    y_events = [np.array([dense(ts[-1])] if status == code else []).reshape(-1, n) for code in (4, 3)]
+    messages = {
+        0: 'The solver successfully reached the end of the integration interval.',
+        -1: 'Required step size is less than spacing between numbers.',
+    }
+    return OptimizeResult(
+        t=np.asarray(t_eval)[:y.shape[1]], y=y, sol=dense, t_events=t_events, y_events=y_events,
+        nfev=nfev, njev=0, nlu=0, status=status if status <= 0 else 1,
+        message=messages.get(status, 'A termination event occurred.'), success=status >= 0,
+    )
@@ -0,0 +1,23 @@
+import importlib
+
+
+class lazy_module:
+    """Stands for a module that is only imported when one of its attributes
+    is first used, so importing the modules that depend on it stays fast.
+    Importing goes through the import system every time, which returns the
+    module already imported after the first one, so it is safe to use while
+    another thread is importing it."""
+    def __init__(self, name):
+        """Initializes the lazy_module class
+        Parameters
+        ----------
+        name : str
+            Name of the module, i.e. 'matplotlib.figure'.
+        """
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+    def __repr__(self):
+        return f'<lazy module {self._name!r}>'
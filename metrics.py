@@ -0,0 +1,163 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+
+try:
+    import resource
+except ImportError: # i.e. on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class histogram:
+    """Distribution of the observed values of a metric, counted in buckets
+    growing geometrically from 1e-4 to 1e8, so it works both for durations in
+    seconds and for counts like the number of evaluations of a solve"""
+    BOUNDS = [10 ** (k / 4) for k in range(-16, 33)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile of the values"""
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count, 'mean': self.total / self.count, 'min': self.min, 'max': self.max,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+        }
+
+def usage():
+    """Returns the CPU seconds and resident memory in bytes used by this process"""
+    rss = None
+    try:
+        with open('/proc/self/statm') as file:
+            rss = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is not None: # peak instead of current, in KiB on Linux
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'cpu': time.process_time(), 'rss': rss}
+
+class registry:
+    """Counters, histograms and gauges of a process. The workers drain theirs
+    after every job and send them back with its result to be merged into the
+    registry of the bot."""
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = defaultdict(histogram)
+        self.gauges = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Observes the seconds spent inside the with block in the histogram name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def event(self, name, **fields):
+        """Counts an event and logs its fields at debug level, so they cost
+        nothing unless debug logging is enabled"""
+        self.count(name)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s', name, json.dumps(fields, default=str))
+
+    def drain(self):
+        """Returns a registry with the metrics recorded since the last drain,
+        along with the usage of this process, and resets them"""
+        drained = registry()
+        drained.counters, self.counters = self.counters, Counter()
+        drained.histograms, self.histograms = self.histograms, defaultdict(histogram)
+        drained.gauges = {f'worker.{os.getpid()}.{k}': v for k, v in usage().items()}
+        return drained
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        for name, h in other.histograms.items():
+            self.histograms[name].merge(h)
+        self.gauges.update(other.gauges)
+
+    def prune(self, pids):
+        """Drops the gauges of the workers whose process id is not in pids,
+        i.e. the ones replaced after a timeout or a crash"""
+        for name in [name for name in self.gauges if name.startswith('worker.')]:
+            if int(name.split('.')[1]) not in pids:
+                del self.gauges[name]
+
+    def snapshot(self):
+        """Returns every metric, and the usage of this process, as a dict"""
+        return {
+            'uptime': time.time() - self.started,
+            'process': usage(),
+            'counters': dict(self.counters),
+            'histograms': {name: h.summary() for name, h in sorted(self.histograms.items())},
+            'gauges': dict(self.gauges),
+        }
+
+    def dump(self, path):
+        """Writes the snapshot of the metrics to a JSON file"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2, default=str)
+        os.replace(tmp, path)
+
+    def report(self):
+        """Returns the snapshot of the metrics as plain text lines"""
+        snapshot = self.snapshot()
+        lines = [f"uptime {snapshot['uptime']:.0f} s, cpu {snapshot['process']['cpu']:.1f} s, "
+                 f"rss {(snapshot['process']['rss'] or 0) / 2**20:.1f} MiB"]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{name} {value}')
+        for name, s in snapshot['histograms'].items():
+            if s['count']:
+                lines.append(f"{name} n={s['count']} mean={s['mean']:.4g} p50={s['p50']:.3g} "
+                             f"p90={s['p90']:.3g} p99={s['p99']:.3g} max={s['max']:.4g}")
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'{name} {value:.4g}' if isinstance(value, float) else f'{name} {value}')
+        return '\n'.join(lines)
+
+
+# metrics of this process
+stats = registry()
@@ -1,7 +1,8 @@
 class model:
     """Defines a system of Ordinary Differential Equations, initial conditions 
     and a time span for the simulation."""
-    def __init__(self, name, f, t_span, initial_conditions, t_eval=10000, p=None, description=None):
+    def __init__(self, name, f, t_span, initial_conditions, t_eval=10000, p=None, description=None,
+                 method='RK45', rtol=1e-3, atol=1e-6, backend='python'):
         """Initializes the model class
         Parameters
         ----------
@@ -21,6 +22,20 @@ class model:
         description : str, optional
             Description of the model. (i.e. what represent each parameter, what
             process is described by the model, etc.) The default is None.
+        method : str, optional
+            Integration method, one of the methods of scipy's solve_ivp or 
+            'auto' to choose between an explicit and an implicit one depending
+            on the stiffness of the system. The default is 'RK45'.
+        rtol : float, optional
+            Relative tolerance of the solver. The default is 1e-3.
+        atol : float, optional
+            Absolute tolerance of the solver. The default is 1e-6.
+        backend : str, optional
+            'python' to evaluate the equations in the interpreter or 'jit' to
+            compile them and the RK45 integrator to machine code with numba,
+            which pays off for long or high resolution integrations. Without
+            numba, or with other methods, 'jit' falls back to 'python'. The
+            default is 'python'.
         """
         self.name = name
         self.f = f
@@ -34,3 +49,7 @@ class model:
         self.t_eval = t_eval
         self.p = p
         self.description = description
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.backend = backend
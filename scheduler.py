@@ -0,0 +1,173 @@
+import asyncio
+from collections import OrderedDict, Counter, deque
+
+from workers import PoolBusy
+
+
+class UserBusy(Exception):
+    """Raised when a user already has as many jobs in the scheduler as allowed"""
+
+class JobCancelled(Exception):
+    """Raised to the users waiting for a job they cancelled"""
+
+
+class pending_job:
+    """Job submitted to the scheduler, shared by every user that submitted the
+    same key while it was queued or running"""
+    def __init__(self, owner, key, fn, args):
+        self.owner = owner
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.waiters = [] # (user, future) of every submission of the job
+        self.task = None  # set when the job starts running
+
+class scheduler:
+    """Admission control in front of the worker pool. Every user can have a
+    limited number of jobs queued or running, the queued jobs are started
+    taking one job of every user in turn so a user submitting many jobs does
+    not delay the others, and jobs submitted again while queued or running
+    are run only once."""
+    def __init__(self, pool, user_jobs=2, queue_size=32):
+        """Initializes the scheduler class
+        Parameters
+        ----------
+        pool : pool
+            Worker pool where the jobs are run.
+        user_jobs : int, optional
+            Number of jobs every user can have queued or running. Further jobs
+            are rejected with UserBusy. The default is 2.
+        queue_size : int, optional
+            Number of jobs allowed to wait for a free worker. When the queue
+            is full new jobs are rejected with PoolBusy. The default is 32.
+        """
+        self.pool = pool
+        self.user_jobs = user_jobs
+        self.queue_size = queue_size
+        self.queued = 0
+        self.running = 0
+        self._queues = OrderedDict() # queued jobs of every user, in the order users take turns
+        self._jobs = {}              # queued and running jobs, by key
+        self._owned = Counter()      # queued and running jobs submitted first by every user
+        self._active = Counter()     # running jobs of every user
+
+    async def run(self, user, key, fn, *args):
+        """Runs fn(*args) in the worker pool on behalf of a user
+        Parameters
+        ----------
+        user : int
+            Identifier of the user, i.e. the chat id.
+        key : str
+            Identifier of the job. Jobs with the same key are assumed to
+            return the same value, so a job already queued or running is
+            not submitted again.
+        fn : function
+            Function to run, see pool.run.
+        *args
+            Arguments of the function.
+        Returns
+        -------
+        object
+            Value returned by the function.
+        """
+        job = self._jobs.get(key)
+        if job is None:
+            if self._owned[user] >= self.user_jobs:
+                raise UserBusy(f'The user already has {self.user_jobs} jobs running.')
+            if self.queued >= self.queue_size:
+                raise PoolBusy('The queue of the scheduler is full.')
+            job = pending_job(user, key, fn, args)
+            self._jobs[key] = job
+            self._owned[user] += 1
+            self._queues.setdefault(user, deque()).append(job)
+            self.queued += 1
+            self._dispatch()
+
+        waiter = asyncio.get_running_loop().create_future()
+        job.waiters.append((user, waiter))
+        try:
+            return await waiter
+        except asyncio.CancelledError: # the handler waiting for the job was cancelled
+            job.waiters.remove((user, waiter))
+            if not job.waiters:
+                self._drop(job)
+            raise
+
+    def cancel(self, user):
+        """Cancels the jobs a user is waiting for. Jobs other users are also
+        waiting for keep running
+        Parameters
+        ----------
+        user : int
+            Identifier of the user.
+        """
+        for job in list(self._jobs.values()):
+            waiters = [waiter for u, waiter in job.waiters if u == user]
+            if not waiters:
+                continue
+            job.waiters = [(u, waiter) for u, waiter in job.waiters if u != user]
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(JobCancelled('The job was cancelled.'))
+            if not job.waiters:
+                self._drop(job)
+
+    def _dispatch(self):
+        """Starts queued jobs while there are free workers, first the ones of
+        the users with fewer jobs running"""
+        while self._queues and self.running < self.pool.workers:
+            user = min(self._queues, key=lambda u: self._active[u]) # the first one in turn on ties
+            queue = self._queues.pop(user)
+            job = queue.popleft()
+            if queue: # the user waits for its next turn after every other user
+                self._queues[user] = queue
+            self.queued -= 1
+            self.running += 1
+            self._active[user] += 1
+            job.task = asyncio.ensure_future(self._execute(job))
+
+    async def _execute(self, job):
+        try:
+            result = await self.pool.run(job.fn, *job.args)
+        except asyncio.CancelledError: # nobody waits for it anymore
+            pass
+        except Exception as e:
+            self._settle(job, exception=e)
+        else:
+            self._settle(job, result=result)
+        finally:
+            self.running -= 1
+            self._active[job.owner] -= 1
+            if not self._active[job.owner]:
+                del self._active[job.owner]
+            self._forget(job)
+            self._dispatch()
+
+    def _settle(self, job, result=None, exception=None):
+        for _, waiter in job.waiters:
+            if waiter.done():
+                continue
+            if exception is not None:
+                waiter.set_exception(exception)
+            else:
+                waiter.set_result(result)
+
+    def _drop(self, job):
+        """Removes a job nobody waits for, killing its worker if it is running"""
+        if job.task is not None:
+            job.task.cancel()
+            self._forget(job) # new submissions of the key start a new job
+            return
+        queue = self._queues[job.owner]
+        queue.remove(job)
+        if not queue:
+            del self._queues[job.owner]
+        self.queued -= 1
+        self._forget(job)
+
+    def _forget(self, job):
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+            self._owned[job.owner] -= 1
+            if not self._owned[job.owner]:
+                del self._owned[job.owner]
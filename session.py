@@ -0,0 +1,260 @@
+import asyncio
+import json
+import pickle
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from cache import sizeof
+from lazy import lazy_module
+
+solver = lazy_module('solver')
+
+
+class session:
+    """State of the conversation of a user. Only the source of the model is
+    stored, as the user entered it, and the model is created from it when
+    needed, so sessions are small and can be pickled. The model and its last
+    solution are kept in memory only."""
+    __slots__ = (
+        'name', 'tutorial', 'variables', 'equations', 'f', 'ts', 'ic', 'te', 'p_names', 'params',
+        'options', 'edit', 'updated', '_model', 'sol',
+    )
+    # fields pickled along with the session, the rest is rebuilt from them
+    PERSISTENT = __slots__[:-2]
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Discards the model and everything entered by the user"""
+        self.name = None     # name of the model, None until it is created
+        self.tutorial = None # tutorial being followed, i.e. 'rd'
+        self.variables = []  # names of the unknowns
+        self.equations = []  # right hand side of the equation of every unknown
+        self.f = None        # equations with the unknowns and parameters replaced by y[i] and p[i]
+        self.ts = None       # time interval
+        self.ic = []         # initial condition of every unknown
+        self.te = 1000       # number of points
+        self.p_names = []    # names of the parameters
+        self.params = None   # value of every parameter, None if there are none
+        self.options = []    # integration method, tolerances and backend
+        self.edit = None     # option being edited
+        self.updated = time.time()
+        self._model = None
+        self.sol = None      # last solution of the model, see solver.solve_model
+
+    def touch(self):
+        """Marks the session as used now"""
+        self.updated = time.time()
+
+    def build(self):
+        """Creates the model from its source, replacing the previous one
+        Returns
+        -------
+        model
+            Model object.
+        """
+        backend = next((i for i in self.options if i.lower() in solver.BACKENDS), None)
+        method, rtol, atol = ([i for i in self.options if i.lower() not in solver.BACKENDS] + [None, None, None])[:3]
+        params = ','.join(self.params) if self.params is not None else None
+        self._model = solver.create_model(
+            self.name, self.f, self.ts, ','.join(self.ic), t_eval=self.te, p=params,
+            method=method, rtol=rtol, atol=atol, backend=backend,
+        )
+        return self._model
+
+    def scenario(self, name):
+        """Sets the model to a scenario of the Romeo and Juliet tutorial, see
+        solver.scenarios, sharing the model already created for it"""
+        ts, ic, params = solver.scenarios[name]
+        self.name, self.f, self.ts, self.te = name, solver.love_func, ts, 1000
+        self.ic, self.params = ic.split(','), params.split(',')
+        self._model = getattr(solver, name)
+
+    @property
+    def model(self):
+        """Model of the session, created again from its source after the
+        session is restored"""
+        if self._model is None and self.name is not None:
+            self.build()
+        return self._model
+
+    @property
+    def size(self):
+        """Bytes of the solution kept by the session"""
+        return sizeof(self.sol)
+
+    def __getstate__(self):
+        return {field: getattr(self, field) for field in self.PERSISTENT}
+
+    def __setstate__(self, state):
+        self.clear()
+        for field, value in state.items():
+            setattr(self, field, value)
+
+
+def expired(sessions, ttl, max_sessions, now=None):
+    """Returns the users whose session must be discarded
+    Parameters
+    ----------
+    sessions : dict
+        Session of every user, by their id.
+    ttl : float
+        Seconds a session can be idle before it is discarded.
+    max_sessions : int
+        Number of sessions kept, the least recently used are discarded first.
+    now : float, optional
+        Current time. The default is None, which uses time.time().
+    Returns
+    -------
+    list
+        Ids of the users.
+    """
+    now = time.time() if now is None else now
+    users = sorted(sessions, key=lambda user: sessions[user].updated)
+    excess = max(len(users) - max_sessions, 0)
+    return users[:excess] + [user for user in users[excess:] if now - sessions[user].updated > ttl]
+
+def trim(sessions, max_size):
+    """Drops the solutions kept by the least recently used sessions until the
+    rest take up at most max_size bytes. They are only kept to resample them
+    when the number of points is edited, so nothing entered by the users is lost.
+    Returns
+    -------
+    int
+        Bytes of the solutions kept.
+    """
+    by_age = sorted(sessions.values(), key=lambda s: s.updated, reverse=True)
+    total = 0
+    for s in by_age:
+        total += s.size
+        if total > max_size:
+            total -= s.size
+            s.sol = None
+    return total
+
+
+class sqlite_persistence(BasePersistence):
+    """Persistence of the sessions, the conversation states and bot_data in a
+    SQLite database, so the bot restarts without losing the models of its
+    users. Sessions idle for longer than the ttl are not loaded again."""
+    def __init__(self, path, ttl, update_interval=60):
+        """Initializes the sqlite_persistence class
+        Parameters
+        ----------
+        path : str
+            Path of the database, created if it does not exist.
+        ttl : float
+            Seconds a session can be idle before it is discarded.
+        update_interval : float, optional
+            Seconds between writes of the changes to the database. The
+            default is 60.
+        """
+        super().__init__(PersistenceInput(chat_data=False, callback_data=False), update_interval)
+        self.path = path
+        self.ttl = ttl
+        # the queries run in the threads of asyncio.to_thread, one at a time
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute('PRAGMA journal_mode=WAL') # writers do not block the readers, nor fsync every commit
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, updated REAL, data BLOB);
+            CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, user_id INTEGER, state INTEGER, PRIMARY KEY (name, key));
+            CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY, data BLOB);
+        """)
+
+    def _commit(self, statements):
+        with self._lock, self._db: # commits
+            for query, args in statements:
+                self._db.execute(query, args)
+
+    def _fetch(self, query, *args):
+        with self._lock:
+            return self._db.execute(query, args).fetchall()
+
+    async def _write(self, *statements):
+        """Runs the (query, args) statements in a single transaction without
+        blocking the event loop"""
+        await asyncio.to_thread(self._commit, statements)
+
+    async def _read(self, query, *args):
+        return await asyncio.to_thread(self._fetch, query, *args)
+
+    async def get_user_data(self):
+        cutoff = (time.time() - self.ttl,)
+        await self._write(
+            ('DELETE FROM conversations WHERE user_id IN (SELECT user_id FROM sessions WHERE updated < ?)', cutoff),
+            ('DELETE FROM sessions WHERE updated < ?', cutoff),
+        )
+        sessions = {}
+        for user_id, data in await self._read('SELECT user_id, data FROM sessions'):
+            try:
+                sessions[user_id] = pickle.loads(data)
+            except (pickle.UnpicklingError, EOFError, AttributeError): # i.e. saved by an incompatible version
+                pass
+        return sessions
+
+    async def update_user_data(self, user_id, data):
+        await self._write((
+            'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+            (user_id, data.updated, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)),
+        ))
+
+    async def drop_user_data(self, user_id):
+        # conversations left behind by a restart before the user came back, see bde_bot.evict_sessions
+        await self._write(
+            ('DELETE FROM conversations WHERE user_id = ?', (user_id,)),
+            ('DELETE FROM sessions WHERE user_id = ?', (user_id,)),
+        )
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        rows = await self._read('SELECT key, state FROM conversations WHERE name = ?', name)
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self._write(('DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key))))
+        else:
+            await self._write(('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)', (name, json.dumps(key), key[-1], new_state)))
+
+    async def get_bot_data(self):
+        rows = await self._read('SELECT data FROM bot_data WHERE id = 0')
+        return pickle.loads(rows[0][0]) if rows else {}
+
+    async def update_bot_data(self, data):
+        await self._write(('INSERT OR REPLACE INTO bot_data VALUES (0, ?)', (pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),)))
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # chat_data and callback_data are not used by the bot
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        def close():
+            with self._lock:
+                self._db.close()
+        await asyncio.to_thread(close)
@@ -1,11 +1,48 @@
+import io
+import copy
+import json
+import hashlib
 from math import *
 
 import numpy as np
-from scipy.integrate import solve_ivp
-import matplotlib.pyplot as plt
-from PIL import Image as im
+from scipy.integrate import solve_ivp, OdeSolution
+from scipy.sparse import csc_matrix, identity, kron
+from scipy.linalg import expm
+from scipy.optimize import OptimizeResult
 
+import jit
+from lazy import lazy_module
+import storage
 from model import model
+from metrics import stats
+from equations import rhs, split_equations
+
+# only the workers plot, so the plotting stack is imported when they first do
+figure = lazy_module('matplotlib.figure')
+mcollections = lazy_module('matplotlib.collections')
+mcolors = lazy_module('matplotlib.colors')
+backend_agg = lazy_module('matplotlib.backends.backend_agg')
+im = lazy_module('PIL.Image')
+
+METHODS = ['RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA', 'auto']
+IMPLICIT_METHODS = ['Radau', 'BDF', 'LSODA']
+BACKENDS = ['python', 'jit']
+STIFFNESS = 1e3     # fastest decay rate times the time interval above which a model is stiff
+STIFF_NFEV = 10000  # evaluations an explicit method can take in auto mode before switching
+DIVERGENCE = 1e12   # absolute value of an unknown above which a solution is considered to blow up
+STEADY_TIME = 1.0   # time over which the derivatives of a steady state change it by less than the tolerances
+MAPPED_POINTS = 2**20  # time points above which the solution is written to disk instead of memory
+CHUNK_POINTS = 2**16   # time points evaluated at once when writing a solution to disk
+
+# rendering profiles, by the client the images are for: dots per inch, and the
+# lossy format, with its quality, of the plots with too many colors for a palette
+PROFILES = {
+    'telegram': {'dpi': 100, 'lossy': 'jpeg', 'quality': 85}, # Telegram recompresses the photos to JPEG anyway
+    'webp': {'dpi': 100, 'lossy': 'webp', 'quality': 80},     # clients showing WebP, smaller than JPEG but slower to encode
+    'file': {'dpi': 150, 'lossy': None},                      # plots saved to disk, never lossy
+}
+PALETTE_COLORS = 16384  # distinct colors up to which a plot is line art, encoded as a 256 color palette PNG
+EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
 
 def create_model(name, f, t_span, initial_conditions, **kwargs):
     """Creates a model object
@@ -13,8 +50,9 @@ def create_model(name, f, t_span, initial_conditions, **kwargs):
     ----------
     name : str
         Name of the model.
-    f : function
-        Function defining the system of ODEs.
+    f : str
+        Equations defining the system of ODEs separated by a comma. They are
+        parsed, validated and compiled once into a single function.
     t_span : 2-tuple
         Tuple containing the start and end time of the simulation.
     initial_conditions : array_like
@@ -30,6 +68,15 @@ def create_model(name, f, t_span, initial_conditions, **kwargs):
             description : str, optional
                 Description of the model. (i.e. what represent each parameter, what
                 process is described by the model, etc.) The default is None.
+            method : str, optional
+                Integration method, one of METHODS. The default is 'RK45'.
+            rtol : float, optional
+                Relative tolerance of the solver. The default is 1e-3.
+            atol : float, optional
+                Absolute tolerance of the solver. The default is 1e-6.
+            backend : str, optional
+                Backend evaluating the equations, one of BACKENDS. The default
+                is 'python'.
     Returns
     -------
     model
@@ -64,89 +111,930 @@ def create_model(name, f, t_span, initial_conditions, **kwargs):
     te = int(kwargs['t_eval']) if ('t_eval' in kwargs and kwargs['t_eval'] is not None) else 1000
     desc = kwargs['description'] if 'description' in kwargs else None
 
-    functions = []
-    for func in [i for i in f.split(',')]:
-        if '=' in func:
-            functions.append(func.split('=')[1])
-        else:
-            functions.append(func)
+    method = kwargs['method'] if ('method' in kwargs and kwargs['method'] is not None) else 'RK45'
+    if method.lower() not in [m.lower() for m in METHODS]:
+        raise ValueError('The method must be one of ' + ', '.join(METHODS) + '.')
+    method = [m for m in METHODS if m.lower() == method.lower()][0]
+    rtol = float(kwargs['rtol']) if ('rtol' in kwargs and kwargs['rtol'] is not None) else 1e-3
+    atol = float(kwargs['atol']) if ('atol' in kwargs and kwargs['atol'] is not None) else 1e-6
+    backend = kwargs['backend'].lower() if ('backend' in kwargs and kwargs['backend'] is not None) else 'python'
+    if backend not in BACKENDS:
+        raise ValueError('The backend must be one of ' + ', '.join(BACKENDS) + '.')
 
+    functions = split_equations(f)
 
     if len(functions) != len(ic):
         raise ValueError('The number of initial conditions must be equal to the number of unknowns.')
 
-    def f(t, y, *p):
-        dydt = []
-        for i in range(len(functions)):
-            dydt.append(eval(functions[i]))
-        return dydt
+    with stats.timer('model.compile'):
+        f = rhs(functions, len(p) if p is not None else 0)
+
+    return model(name, f, ts, ic, te, p, desc, method, rtol, atol, backend)
+
+def integration_key(model):
+    """Returns a canonical hash identifying the trajectory of a model, which
+    does not depend on the end of the time span nor on the number of points
+    Parameters
+    ----------
+    model : model
+        Model to identify.
+    Returns
+    -------
+    str
+        Hex digest of the hash of the compiled equations, parameters, initial
+        conditions, start time and solver options of the model.
+    """
+    key = {
+        'f': model.f.key,
+        'p': [float(i) for i in model.p] if model.p is not None else None,
+        'ic': [float(i) for i in model.initial_conditions],
+        't0': float(model.t_span[0]),
+        'solver': [model.method, float(model.rtol), float(model.atol), model.backend],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def model_key(model, *extra):
+    """Returns a canonical hash identifying the solution of a model
+    Parameters
+    ----------
+    model : model
+        Model to identify.
+    *extra
+        Additional values identifying the result, i.e. the name used in the
+        title of the plots.
+    Returns
+    -------
+    str
+        Hex digest of the hash of the compiled equations, parameters, initial
+        conditions, time span, number of points and solver options of the model.
+    """
+    key = {
+        'trajectory': integration_key(model),
+        'ts': [float(i) for i in model.t_span],
+        'te': int(model.t_eval),
+        'extra': extra,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def last_value(f):
+    """Wraps f(t, y) to return the last value again when called twice in a
+    row at the same point, as the events are evaluated at the point where
+    most methods just evaluated the equations"""
+    last = [None, None, None]
+    def cached(t, y):
+        if last[0] == t and np.array_equal(last[1], y):
+            return last[2]
+        last[:] = t, np.copy(y), f(t, y)
+        return last[2]
+    return cached
+
+def termination_events(model, f):
+    """Returns the terminal events stopping the integration of a model when
+    it diverges and, if its equations do not depend on t, when it comes
+    close to a steady state: when its derivatives would change it by less
+    than the tolerances over STEADY_TIME
+    Parameters
+    ----------
+    model : model
+        Model to solve.
+    f : function
+        Function f(t, y) of the system, see last_value.
+    Returns
+    -------
+    list
+        Events for solve_ivp, the divergence first.
+    """
+    def diverged(t, y):
+        y = np.asarray(y, dtype=float)
+        return np.max(np.abs(y)) - DIVERGENCE if np.all(np.isfinite(y)) else 1.0
+    diverged.terminal, diverged.direction = True, 1
+
+    def steady(t, y):
+        y = np.asarray(y, dtype=float)
+        return np.max(np.abs(f(t, y)) * STEADY_TIME / (model.atol + np.abs(y) * model.rtol)) - 1
+    steady.terminal, steady.direction = True, -1
+
+    return [diverged, steady] if model.f.autonomous else [diverged]
+
+def linearize(model, p, t, y):
+    """Returns the linearization of the equations of a model around a state
+    close to an equilibrium, y' = A y + b, with A the Jacobian at the state
+    Parameters
+    ----------
+    model : model
+        Model solved.
+    p : list
+        Values of the parameters.
+    t : float
+        Time of the state.
+    y : array_like
+        State, where the derivatives are small, see termination_events.
+    Returns
+    -------
+    tuple
+        A and b, or None if the equilibrium is unstable or further than a
+        few times the tolerances. Without a Jacobian, the state is kept as
+        it is, A and b being zero.
+    """
+    n = len(y)
+    dy = model.f.bind(*p)(t, y)
+    jac = model.f.bind_jac(*p)
+    if jac is None:
+        return np.zeros((n, n)), np.zeros(n)
+    A = jac(t, y)
+    A = A.toarray() if hasattr(A, 'toarray') else A
+    re = np.linalg.eigvals(A).real
+    if not np.all(np.isfinite(re)) or re.max() > np.sqrt(np.finfo(float).eps) * max(1.0, np.abs(re).max()):
+        return None
+    # Newton step to the equilibrium, which must be within a few times
+    # the tolerances: the derivatives may be small only because the
+    # state moves slowly
+    step = np.linalg.lstsq(A, dy, rcond=None)[0]
+    if np.max(np.abs(step) / (model.atol + np.abs(y) * model.rtol)) > 10:
+        return None
+    return A, dy - A @ y
+
+def settle(sol, model):
+    """Completes a solution stopped close to a steady state up to the end of
+    the time span of its model with the linearization of the equations
+    around it, the closed form decay towards the equilibrium, instead of
+    integrating it
+    Parameters
+    ----------
+    sol : OdeResult
+        Solution stopped by the steady state event, see termination_events.
+    model : model
+        Model solved.
+    Returns
+    -------
+    OdeResult
+        Completed solution, or None if the equilibrium is unstable or
+        further than the tolerances, and the integration must go on.
+    """
+    te, ye = sol.t_events[1][0], sol.y_events[1][0]
+    linearization = linearize(model, model.p or [], te, ye)
+    if linearization is None:
+        return None
+
+    fill = linear_solution(*linearization, ye, (te, model.t_span[1]))
+    dense = OdeSolution(np.array([sol.sol.t_min, te, model.t_span[1]]), [sol.sol, fill])
+    settled = copy.copy(sol)
+    settled.t, settled.y = sample(dense, model)
+    settled.sol = dense
+    settled.stopped = 'steady'
+    settled.message = f'Settled at a steady state at t = {te:.6g}.'
+    return settled
+
+class StiffnessDetected(Exception):
+    """Raised when an explicit method exceeds its budget of evaluations in auto mode"""
+
+def is_stiff(model):
+    """Estimates whether a model is stiff from the eigenvalues of its Jacobian
+    at the initial conditions: it is if its fastest decaying mode is much
+    faster than the time interval
+    Parameters
+    ----------
+    model : model
+        Model to check. Its equations must be differentiable.
+    Returns
+    -------
+    bool
+        Whether the model is stiff or not.
+    """
+    J = model.f.bind_jac(*(model.p or []))(model.t_span[0], np.asarray(model.initial_conditions, dtype=float))
+    J = J.toarray() if hasattr(J, 'toarray') else J
+    re = np.linalg.eigvals(J).real
+    if not np.all(np.isfinite(re)) or not np.any(re < 0):
+        return False
+    return -re.min() * (model.t_span[1] - model.t_span[0]) > STIFFNESS
+
+def solver_options(model, method=None):
+    """Returns the options of solve_ivp to solve a model
+    Parameters
+    ----------
+    model : model
+        Model to solve.
+    method : str, optional
+        Method to use instead of the method of the model. The default is None.
+    Returns
+    -------
+    dict
+        Method, tolerances and, for implicit methods, the Jacobian derived 
+        from the equations or its sparsity pattern if it can not be derived.
+    """
+    method = method or model.method
+    if method == 'auto':
+        if not model.f.differentiable:
+            method = 'LSODA' # switches between stiff and non stiff methods itself
+        else:
+            method = 'Radau' if is_stiff(model) else 'RK45'
+
+    options = {'method': method, 'rtol': model.rtol, 'atol': model.atol}
+    if method in IMPLICIT_METHODS:
+        if model.f.differentiable:
+            options['jac'] = model.f.bind_jac(*(model.p or []))
+        elif method != 'LSODA':
+            options['jac_sparsity'] = model.f.sparsity
+    return options
+
+def sample(dense, model):
+    """Evaluates a dense output at the time points of a model. Up to
+    MAPPED_POINTS points the solution is kept in memory, more are evaluated
+    CHUNK_POINTS at a time and written into memory-mapped files on disk, so
+    the memory used does not grow with the number of points
+    Parameters
+    ----------
+    dense : callable
+        Dense output of a solution, i.e. an OdeSolution. Its grid method is
+        used instead when it has one, see linear_solution.
+    model : model
+        Model whose time points are evaluated.
+    Returns
+    -------
+    tuple
+        Time points and solution at them, as arrays or, when written to disk,
+        as storage.disk_array. The time points after the end of the dense
+        output, where an integration stopped early, are left out instead of
+        extrapolated.
+    """
+    evaluate = getattr(dense, 'grid', dense)
+    t0, t1 = (float(i) for i in model.t_span)
+    if model.t_eval <= MAPPED_POINTS:
+        t_eval = np.linspace(t0, t1, model.t_eval)
+        t_eval = t_eval[:np.searchsorted(t_eval, dense.t_max, side='right')]
+        return t_eval, evaluate(t_eval)
+
+    n, size = len(model.initial_conditions), int(model.t_eval)
+    t_path, t_out = storage.allocate((size,))
+    y_path, y_out = storage.allocate((n, size))
+    step, stop = (t1 - t0) / (size - 1), size
+    for start in range(0, size, CHUNK_POINTS):
+        end = min(start + CHUNK_POINTS, size)
+        t = t0 + np.arange(start, end) * step # the same points as np.linspace
+        if end == size:
+            t[-1] = t1
+        if t[-1] > dense.t_max:
+            stop = start + int(np.searchsorted(t, dense.t_max, side='right'))
+            t = t[:stop - start]
+        t_out[start:start + len(t)] = t
+        y_out[:, start:start + len(t)] = evaluate(t)
+        if stop < size:
+            break
+    t_out.flush()
+    y_out.flush()
+    del t_out, y_out
+    return storage.disk_array(t_path, stop), storage.disk_array(y_path, stop)
+
+def resample(sol, model):
+    """Evaluates the dense output of a previous solution at the time points of
+    a model, without integrating again
+    Parameters
+    ----------
+    sol : OdeResult
+        Solution with dense output covering the time span of the model.
+    model : model
+        Model to evaluate.
+    Returns
+    -------
+    OdeResult
+        Solution of the model.
+    """
+    resampled = copy.copy(sol)
+    resampled.t, resampled.y = sample(sol.sol, model)
+    resampled.nfev, resampled.njev, resampled.nlu = 0, 0, 0
+    resampled.message = 'Resampled from a previous solution.'
+    # the stop of the previous solution may lie after the end of the new time span
+    stopped, t1 = sol.get('stopped'), model.t_span[1]
+    if stopped == 'diverged' and t1 < sol.sol.t_max or stopped == 'steady' and t1 <= sol.t_events[1][0]:
+        resampled.stopped, resampled.status = None, 0
+        resampled.t_events = [np.array([]) for _ in sol.t_events]
+        resampled.y_events = [np.empty((0, len(model.initial_conditions))) for _ in sol.t_events]
+    return resampled
+
+def extend(sol, model, steady=True):
+    """Continues the integration of a previous solution from its final state
+    and step size up to the end of the time span of a model, splicing both
+    segments together. Like solve_model, it stops where the solution
+    diverges and settles at steady states
+    Parameters
+    ----------
+    sol : OdeResult
+        Solution with dense output starting at the start time of the model.
+    model : model
+        Model to solve.
+    steady : bool, optional
+        Whether to stop at steady states or not, i.e. right after passing
+        by an unstable equilibrium. The default is True.
+    Returns
+    -------
+    OdeResult
+        Solution of the model, with the dense output of both segments. If
+        the integration failed, its status and message are the ones of the
+        failure and the solution ends where it did.
+    """
+    t0, t1 = sol.sol.t_max, model.t_span[1]
+    first_step = min(sol.sol.ts[-1] - sol.sol.ts[-2], t1 - t0) if len(sol.sol.ts) > 1 else None
+    options = solver_options(model, sol.method)
+
+    f = last_value(model.f.bind(*(model.p or [])))
+    events = termination_events(model, f)
+    segment = solve_ivp(
+        f, (t0, t1), sol.sol(t0), dense_output=True, first_step=first_step,
+        events=events if steady else events[:1], **options
+    )
+    if len(segment.sol.ts) > 1:
+        dense = OdeSolution(np.concatenate([sol.sol.ts, segment.sol.ts[1:]]), sol.sol.interpolants + segment.sol.interpolants)
+    else: # failed at its first step
+        dense = sol.sol
+
+    extended = copy.copy(segment)
+    extended.sol = dense
+    extended.method = sol.method
+    extended.key = sol.key
+    if segment.status == 1 and not len(segment.t_events[0]): # at a steady state
+        settled = settle(extended, model)
+        # passing by an unstable equilibrium, the rest is integrated without stopping there
+        return settled if settled is not None else extend(extended, model, steady=False)
+    extended.t, extended.y = sample(dense, model)
+    extended.stopped = 'diverged' if segment.status == 1 else None
+    return extended
+
+class linear_solution:
+    """Closed form solution of a linear model with constant coefficients,
+    y' = A y + b. Callable as the dense output of solve_ivp."""
+    def __init__(self, A, b, y0, t_span):
+        """Initializes the linear_solution class
+        Parameters
+        ----------
+        A : array_like
+            Coefficient matrix of the system, of shape (n, n).
+        b : array_like
+            Constant term of the system, of shape (n,).
+        y0 : array_like
+            Initial conditions of the system, at t_span[0].
+        t_span : 2-tuple
+            Time span of the solution.
+        """
+        n = len(y0)
+        # augmented system z' = M z with z = (y, 1), so z(t) = expm(M (t - t0)) z0
+        self.M = np.zeros((n + 1, n + 1))
+        self.M[:n, :n] = A
+        self.M[:n, n] = b
+        self.z0 = np.append(np.asarray(y0, dtype=float), 1.0)
+        self.t_min, self.t_max = t_span
 
-    return model(name, f, ts, ic, te, p, desc)
+        w, V = np.linalg.eig(self.M)
+        if np.linalg.cond(V) < 1e8: # diagonalizable, z(t) = V exp(w (t - t0)) V^-1 z0
+            c = np.linalg.solve(V, self.z0)
+            # the modes not excited by the initial conditions are left out, as a growing one would
+            # overflow and its zero coefficient would turn the solution into nan. The coefficients
+            # go into the exponent, so small ones only overflow where their mode really does
+            excited = c != 0
+            self.w, self.V, self.log_c = w[excited], V[:, excited], np.log(c[excited].astype(complex))
+        else:
+            self.w, self.V, self.log_c = None, None, None
+
+    def __call__(self, t):
+        """Evaluates the solution at t, a scalar or an array of times"""
+        tau = np.atleast_1d(np.asarray(t, dtype=float)) - self.t_min
+        if self.V is not None:
+            z = (self.V @ np.exp(np.outer(self.w, tau) + self.log_c[:, None])).real
+        else:
+            z = np.stack([expm(self.M * s) @ self.z0 for s in tau], axis=1)
+        return z[:-1, 0] if np.ndim(t) == 0 else z[:-1]
+
+    def grid(self, t):
+        """Evaluates the solution at the evenly spaced times t. Defective
+        systems are propagated block by block with the exponential of a
+        single step instead of one exponential per point"""
+        if self.V is not None or len(t) < 2:
+            return self(t)
+        step = expm(self.M * (t[1] - t[0]))
+        block = max(1, int(np.sqrt(len(t))))
+        z = np.empty((len(self.z0), len(t)))
+        z[:, 0] = expm(self.M * (t[0] - self.t_min)) @ self.z0
+        for k in range(1, min(block, len(t))):
+            z[:, k] = step @ z[:, k - 1]
+        jump = expm(self.M * (t[block] - t[0])) if block < len(t) else None
+        for k in range(block, len(t), block):
+            end = min(k + block, len(t))
+            z[:, k:end] = jump @ z[:, k - block:end - block]
+        return z[:-1]
+
+def solve_linear(model):
+    """Solves a linear model with constant coefficients in closed form,
+    without integrating step by step
+    Parameters
+    ----------
+    model : model
+        Model to solve. Its equations must be linear, see equations.affine.
+    Returns
+    -------
+    OdeResult
+        Solution of the model, exact at every time point.
+    """
+    t0 = model.t_span[0]
+    zeros = np.zeros(len(model.initial_conditions))
+    A = model.f.bind_jac(*(model.p or []))(t0, zeros)
+    A = A.toarray() if hasattr(A, 'toarray') else A
+    b = model.f.bind(*(model.p or []))(t0, zeros)
+
+    dense = linear_solution(A, b, model.initial_conditions, model.t_span)
+    t_eval, y = sample(dense, model)
+    stopped, message = None, 'Solved in closed form.'
+    if isinstance(y, np.ndarray): # cut where it blows up, like the divergence event
+        beyond = ~np.all(np.abs(y) <= DIVERGENCE, axis=0)
+        if beyond.any():
+            k = int(np.argmax(beyond))
+            t_eval, y = t_eval[:k], y[:, :k]
+            stopped, message = 'diverged', 'Solved in closed form until it diverged.'
+    return OptimizeResult(
+        t=t_eval, y=y, sol=dense, t_events=None, y_events=None,
+        nfev=0, njev=0, nlu=0, status=0, message=message, success=True,
+        method='closed form', key=integration_key(model), stopped=stopped,
+    )
 
-def solve_model(model):
+def solve_model(model, previous=None):
     """Solves a model
     Parameters
     ----------
     model : model
         Model to solve.
+    previous : OdeResult, optional
+        Previous solution of the model. If it follows the same trajectory 
+        (same equations, parameters, initial conditions, start time and
+        solver options) it is resampled where it covers the time span of the
+        model and only the rest of the time span is integrated. The default
+        is None.
     Returns
     -------
     array_like
-        Array containing the solution of the model.
+        Array containing the solution of the model, with dense output. Linear
+        models with constant coefficients are solved in closed form. Above
+        MAPPED_POINTS time points, t and y are kept on disk, see solve_mapped.
     """
-    sol = solve_ivp(model.f, model.t_span, model.initial_conditions, t_eval=np.linspace(model.t_span[0], model.t_span[1], model.t_eval), args=model.p)
+    if model.f.linear:
+        return solve_linear(model)
+
+    key = integration_key(model)
+    if previous is not None and previous.get('key') == key and previous.sol is not None:
+        if model.t_span[1] <= previous.sol.t_max:
+            return resample(previous, model)
+        # the steps of the compiled integrator can not be spliced, stopped
+        # solutions were decided by their own time span, and the steps of
+        # solutions too large for memory are not kept
+        if isinstance(previous.sol, OdeSolution) and previous.get('stopped') is None and model.t_eval <= MAPPED_POINTS:
+            return extend(previous, model)
+
+    options = solver_options(model)
+    f = last_value(model.f.bind(*(model.p or [])))
+    events = termination_events(model, f)
+    if model.t_eval > MAPPED_POINTS:
+        return solve_mapped(model, options, f, events)
+    t_eval = np.linspace(model.t_span[0], model.t_span[1], model.t_eval)
+    steady = STEADY_TIME if model.f.autonomous else 0
+
+    sol = None
+    if model.backend == 'jit' and options['method'] == 'RK45' and jit.compile_rhs(model.f) is not None:
+        sol = jit.solve(model, t_eval, STIFF_NFEV if model.method == 'auto' else 0, steady, DIVERGENCE)
+        if sol is None: # exceeded its budget of evaluations in auto mode
+            options = solver_options(model, 'Radau')
+    elif model.method == 'auto' and options['method'] not in IMPLICIT_METHODS:
+        # the estimate may miss stiffness appearing later, so the explicit
+        # method gets a budget of evaluations before switching to an implicit one
+        nfev = 0
+        def budget(t, y):
+            nonlocal nfev
+            nfev += 1
+            if nfev > STIFF_NFEV:
+                raise StiffnessDetected()
+            return f(t, y)
+        try:
+            sol = solve_ivp(
+                budget, model.t_span, model.initial_conditions, t_eval=t_eval, dense_output=True, events=events, **options
+            )
+        except StiffnessDetected:
+            options = solver_options(model, 'Radau')
+
+    if sol is None:
+        sol = solve_ivp(f, model.t_span, model.initial_conditions, t_eval=t_eval, dense_output=True, events=events, **options)
+    sol.method = options['method']
+    sol.key = key
+
+    if sol.status == 1 and not len(sol.t_events[0]): # at a steady state
+        settled = settle(sol, model)
+        if settled is not None:
+            return settled
+        # passing by an unstable equilibrium, the rest is integrated without stopping there
+        if isinstance(sol.sol, OdeSolution):
+            return extend(sol, model, steady=False)
+        sol = jit.solve(model, t_eval, 0, 0, DIVERGENCE)
+        sol.method = options['method']
+        sol.key = key
+
+    sol.stopped = 'diverged' if sol.status == 1 else None
     return sol
 
-def plot_model(model_name, sol, show=True, save=False):
-    """Plots the solution of a model
+def solve_mapped(model, options, f, events):
+    """Solves a model with more than MAPPED_POINTS time points, advancing
+    the integration CHUNK_POINTS time points at a time and writing the
+    solution at them into memory-mapped files as soon as they are done.
+    Neither the samples nor the steps of the integration are kept, so the
+    memory used grows neither with the number of points nor with the time
+    span. It stops when the solution diverges and settles at steady states
+    like solve_model, and in auto mode switches to an implicit method once
+    the explicit one exceeds its budget of evaluations
+    Parameters
+    ----------
+    model : model
+        Model to solve.
+    options : dict
+        Options of solve_ivp, see solver_options.
+    f : function
+        Function f(t, y) of the system, see last_value.
+    events : list
+        Terminal events, see termination_events.
+    Returns
+    -------
+    OdeResult
+        Solution of the model, with t and y as storage.disk_array and without
+        dense output. The time points after an early stop are left out.
+    """
+    n, size = len(model.initial_conditions), int(model.t_eval)
+    t0, t1 = (float(i) for i in model.t_span)
+    t_path, t_out = storage.allocate((size,))
+    y_path, y_out = storage.allocate((n, size))
+    step = (t1 - t0) / (size - 1)
+
+    compiled = model.backend == 'jit' and options['method'] == 'RK45' and jit.compile_rhs(model.f) is not None
+    budget = STIFF_NFEV if model.method == 'auto' and options['method'] not in IMPLICIT_METHODS else 0
+    steady = STEADY_TIME if model.f.autonomous else 0
+    nfev = 0
+    def counted(t, y):
+        nonlocal nfev
+        nfev += 1
+        if budget and nfev > budget:
+            raise StiffnessDetected()
+        return f(t, y)
+
+    ta, y = t0, np.asarray(model.initial_conditions, dtype=float)
+    njev, nlu, start, stop = 0, 0, 0, size
+    fill, stopped = None, None
+    status, message = 0, 'The solver successfully reached the end of the integration interval.'
+    t_events, y_events = [np.array([]) for _ in events], [np.empty((0, n)) for _ in events]
+    while start < size:
+        end = min(start + CHUNK_POINTS, size)
+        t = t0 + np.arange(start, end) * step # the same points as np.linspace
+        if end == size:
+            t[-1] = t1
+        if fill is not None: # settled, the rest is the decay towards the equilibrium
+            t_out[start:end], y_out[:, start:end] = t, fill.grid(t)
+            start = end
+            continue
+
+        if compiled:
+            window = jit.solve(
+                model, t, max(budget - nfev, 1) if budget else 0, steady, DIVERGENCE, t_span=(ta, t[-1]), y0=y
+            )
+            if window is None: # exceeded its budget of evaluations in auto mode
+                compiled, budget, options = False, 0, solver_options(model, 'Radau')
+                continue
+            nfev += window.nfev
+        else:
+            try:
+                window = solve_ivp(counted, (ta, t[-1]), y, t_eval=t, events=events, **options)
+            except StiffnessDetected: # the window is integrated again with the implicit method
+                budget, options = 0, solver_options(model, 'Radau')
+                continue
+        njev, nlu = njev + window.njev, nlu + window.nlu
+
+        k = len(window.t)
+        t_out[start:start + k], y_out[:, start:start + k] = window.t, window.y
+        start += k
+        if window.status == 1 and not len(window.t_events[0]): # at a steady state
+            te, ye = window.t_events[1][0], window.y_events[1][0]
+            linearization = linearize(model, model.p or [], te, ye)
+            if linearization is not None:
+                fill, stopped = linear_solution(*linearization, ye, (te, t1)), 'steady'
+                t_events, y_events = window.t_events, window.y_events
+                message = f'Settled at a steady state at t = {te:.6g}.'
+            else: # passing by an unstable equilibrium, the rest is integrated without stopping there
+                events, steady = events[:1], 0
+                ta, y = te, ye
+            continue
+        if window.status != 0: # diverged or failed
+            stop, status, message = start, window.status, window.message
+            stopped = 'diverged' if window.status == 1 else None
+            t_events, y_events = window.t_events, window.y_events
+            break
+        ta, y = t[-1], window.y[:, -1]
+
+    t_out.flush()
+    y_out.flush()
+    del t_out, y_out
+    return OptimizeResult(
+        t=storage.disk_array(t_path, stop), y=storage.disk_array(y_path, stop), sol=None,
+        t_events=t_events, y_events=y_events, nfev=nfev, njev=njev, nlu=nlu, status=status,
+        message=message, success=status >= 0, method=options['method'], key=integration_key(model), stopped=stopped,
+    )
+
+def sweep_model(model, target, index, values):
+    """Solves an ensemble of copies of a model that differ in the value of one
+    parameter or initial condition. The whole ensemble is integrated at once
+    as a single vectorized system.
+    Parameters
+    ----------
+    model : model
+        Model to sweep.
+    target : str
+        'p' to sweep a parameter or 'ic' to sweep an initial condition.
+    index : int
+        Index of the parameter or initial condition to sweep.
+    values : array_like
+        Values of the swept parameter or initial condition, one for each
+        member of the ensemble.
+    Returns
+    -------
+    OdeResult
+        Solution of the ensemble. y has shape (m, n, t_eval), the solution of
+        every member stacked, and swept holds the swept values. Like
+        solve_model, the integration stops when some member diverges, and
+        once every member is close to a stable steady state the rest is
+        filled with their linearizations.
+    """
+    values = np.asarray(values, dtype=float)
+    n, m = len(model.initial_conditions), len(values)
+    if m * model.t_eval > MAPPED_POINTS: # the ensemble is kept in memory
+        raise ValueError(
+            f"The number of values times the number of points of a sweep must be at most {MAPPED_POINTS}."
+        )
+
+    p = list(model.p) if model.p is not None else []
+    y0 = np.repeat(np.asarray(model.initial_conditions, dtype=float)[:, None], m, axis=1)
+    if target == 'p':
+        p[index] = values
+    elif target == 'ic':
+        y0[index] = values
+    else:
+        raise ValueError("The swept target must be either 'p' or 'ic'.")
+
+    f = model.f.vectorized(*p)
+    def batch(t, y):
+        return f(t, y.reshape(n, m)).ravel()
+    batch = last_value(batch)
+    events = termination_events(model, batch)
+
+    method = model.method if model.method != 'auto' else 'LSODA'
+    options = {'method': method, 'rtol': model.rtol, 'atol': model.atol}
+    if method in ('Radau', 'BDF'): # members are independent, the Jacobian is block diagonal
+        options['jac_sparsity'] = kron(csc_matrix(model.f.sparsity), identity(m), format='csc')
+
+    t_eval = np.linspace(model.t_span[0], model.t_span[1], model.t_eval)
+    sol = solve_ivp(batch, model.t_span, y0.ravel(), t_eval=t_eval, events=events, **options)
+    sol.stopped = 'diverged' if sol.status == 1 else None
+
+    if sol.status == 1 and not len(sol.t_events[0]): # every member at a steady state
+        te, ye = sol.t_events[1][0], sol.y_events[1][0]
+        rest = t_eval[len(sol.t):]
+        members = []
+        for k in range(m):
+            pk = list(p)
+            if target == 'p':
+                pk[index] = values[k]
+            members.append(linearize(model, pk, te, ye.reshape(n, m)[:, k]))
+        if all(linearization is not None for linearization in members):
+            fill = [linear_solution(*linearization, ye.reshape(n, m)[:, k], (te, model.t_span[1]))(rest)
+                    for k, linearization in enumerate(members)]
+            y_rest = np.stack(fill, axis=1).reshape(n * m, -1)
+            sol.stopped = 'steady'
+        else: # some member passes by an unstable equilibrium, the rest is integrated without stopping there
+            segment = solve_ivp(batch, (te, model.t_span[1]), ye, t_eval=rest, events=events[:1], **options)
+            y_rest = segment.y
+            sol.nfev += segment.nfev
+            sol.t_events = segment.t_events
+            sol.stopped = 'diverged' if segment.status == 1 else None
+        sol.t, sol.y = np.concatenate([sol.t, rest[:y_rest.shape[1]]]), np.hstack([sol.y, y_rest])
+
+    sol.y = sol.y.reshape(n, m, -1).transpose(1, 0, 2)
+    sol.swept = values
+    return sol
+
+def encode(image, profile='telegram'):
+    """Encodes an image in the cheapest format that suits its content. Line
+    art, with a few colors and their antialiasing blends, is quantized to a
+    palette PNG, which is both smaller and faster to encode than a full color
+    one. Images with more colors, i.e. colormaps or shaded surfaces, are
+    encoded in the lossy format of the profile, if any.
+    Parameters
+    ----------
+    image : array_like
+        RGBA image, of shape (height, width, 4), on an opaque background.
+    profile : str, optional
+        Rendering profile, one of PROFILES. The default is 'telegram'.
+    Returns
+    -------
+    tuple
+        Encoded image and its format, one of EXTENSIONS.
+    """
+    options = PROFILES[profile]
+    rgb = im.fromarray(np.asarray(image)).convert('RGB')
+    if rgb.getcolors(PALETTE_COLORS) is not None:
+        fmt, rgb = 'png', rgb.quantize(256, method=im.Quantize.FASTOCTREE, dither=im.Dither.NONE)
+        kwargs = {'compress_level': 6}
+    elif options['lossy'] == 'jpeg':
+        fmt, kwargs = 'jpeg', {'quality': options['quality']}
+    elif options['lossy'] == 'webp':
+        fmt, kwargs = 'webp', {'quality': options['quality'], 'method': 0} # the fastest method
+    else:
+        fmt, kwargs = 'png', {'compress_level': 1} # a higher level takes twice as long for a few percent
+
+    buf = io.BytesIO()
+    with stats.timer(f'plot.encode.{fmt}'):
+        rgb.save(buf, format=fmt, dpi=(options['dpi'], options['dpi']), **kwargs)
+    stats.observe(f'plot.bytes.{fmt}', buf.tell())
+    return buf.getvalue(), fmt
+
+def extension(image):
+    """Returns the file extension of an encoded image, from its signature"""
+    if image.startswith(b'\x89PNG'):
+        return 'png'
+    if image.startswith(b'\xff\xd8'):
+        return 'jpg'
+    if image[8:12] == b'WEBP':
+        return 'webp'
+    raise ValueError('Unknown image format.')
+
+def render(fig, profile='telegram'):
+    """Renders a figure into an in-memory image
+    Parameters
+    ----------
+    fig : matplotlib.figure.Figure
+        Figure to render, created with the dpi of the profile.
+    profile : str, optional
+        Rendering profile, one of PROFILES. The default is 'telegram'.
+    Returns
+    -------
+    bytes
+        Encoded image, see encode.
+    """
+    canvas = backend_agg.FigureCanvasAgg(fig)
+    with stats.timer('plot.draw'):
+        canvas.draw()
+    with stats.timer('plot.encode'):
+        return encode(canvas.buffer_rgba(), profile)[0]
+
+def downsample(y, buckets):
+    """Selects the points of curves worth drawing at a given width: the first,
+    last, lowest and highest point of every bucket of consecutive points, so
+    the extrema and oscillations of the curves are kept
+    Parameters
+    ----------
+    y : array_like
+        Values of the curves, of shape (n,) or (curves, n). The points selected
+        for any of the curves are selected for all of them.
+    buckets : int
+        Number of buckets, i.e. the width in pixels of the plot.
+    Returns
+    -------
+    array_like
+        Sorted indices of the selected points.
+    """
+    y = np.atleast_2d(y)
+    n = y.shape[1]
+    if n <= 4 * buckets:
+        return np.arange(n)
+
+    size = -(-n // buckets)
+    indices = []
+    # the buckets are read in blocks, so curves mapped from disk are never loaded whole
+    block = max(1, CHUNK_POINTS // size) * size
+    for offset in range(0, n, block):
+        chunk = np.asarray(y[:, offset:offset + block])
+        count = -(-chunk.shape[1] // size)
+        padded = np.pad(chunk, ((0, 0), (0, size * count - chunk.shape[1])), mode='edge').reshape(len(y), count, size)
+        start = offset + np.arange(count) * size
+        indices += [start, np.minimum(start + size - 1, n - 1)]
+        indices += [start + padded.argmin(axis=2), start + padded.argmax(axis=2)]
+    return np.unique(np.minimum(np.concatenate([np.ravel(i) for i in indices]), n - 1))
+
+def plot_model(model_name, sol, save=False, profile='telegram'):
+    """Plots the solution of a model. Every call draws on its own figures and
+    renders them in memory, so several plots can be made in parallel.
     Parameters
     ----------
     mode_name : str
         Name of the model.
     sol : array_like
         Solution of the model to plot.
-    show : bool, optional
-        Whether to show the plot or not. The default is True.
     save : bool, optional
-        Whether to save the plot or not. The default is False.
-    path : str, optional
-        Path to the file to save the plot to. The default is None.
-    """
-    i = 0
-    for curve in sol.y:
-        plt.plot(sol.t, curve, label = 'y' + str(i) + '(t)')
-        i += 1
-    plt.xlabel('t')
-    plt.ylabel('yi(t)')
-    plt.legend(loc='best')
+        Whether to also save the plots to model_name + '.png' (and 
+        model_name + '3d.png') or not, with the extension of their format.
+        The default is False.
+    profile : str, optional
+        Rendering profile, one of PROFILES. The default is 'telegram'.
+    Returns
+    -------
+    list
+        List containing the images of the plot of every unknown against
+        time and, for systems of 3 unknowns, of the 3D trajectory. The curves
+        are downsampled to the width of the images, see downsample.
+    """
+    images = []
+    dpi = PROFILES[profile]['dpi']
+
+    fig = figure.Figure(dpi=dpi)
+    ax = fig.add_subplot()
+    # no more points than the pixels of the image can show
+    buckets = int(fig.get_figwidth() * fig.dpi)
+    for i, curve in enumerate(sol.y):
+        k = downsample(curve, buckets)
+        ax.plot(sol.t[k], curve[k], label = 'y' + str(i) + '(t)')
+    ax.set_xlabel('t')
+    ax.set_ylabel('yi(t)')
+    ax.legend(loc='best')
     if model_name is not None:
-        plt.title(model_name)
-    if save:
-        path = model_name + '.png'
-        plt.savefig(path)
-        plt.close()
-    if show:
-        plt.show()
+        ax.set_title(model_name)
+    images.append(render(fig, profile))
 
     if len(sol.y) == 3:
-        ax = plt.axes(projection='3d')
-        ax.plot3D(sol.y[0], sol.y[1], sol.y[2])
+        fig = figure.Figure(dpi=dpi)
+        ax = fig.add_subplot(projection='3d')
+        # the trajectory does not advance along any axis of the image like
+        # time does, so straight segments between the kept points would show
+        k = downsample(sol.y, 16 * buckets)
+        ax.plot3D(sol.y[0][k], sol.y[1][k], sol.y[2][k])
         ax.set_xlabel('y0(t)')
         ax.set_ylabel('y1(t)')
         ax.set_zlabel('y2(t)')
         ax.set_title(model_name)
-        if save:
-            path = model_name + '3d.png'
-            plt.savefig(path)
-            plt.close()
-        if show:
-            plt.show()
+        images.append(render(fig, profile))
+
+    if save:
+        for image, suffix in zip(images, ['', '3d']):
+            with open(model_name + suffix + '.' + extension(image), 'wb') as file:
+                file.write(image)
+
+    return images
+
+def plot_sweep(model_name, sol, label, profile='telegram'):
+    """Plots the solution of an ensemble in a single image, with a panel for
+    every unknown and the members colored by their swept value
+    Parameters
+    ----------
+    model_name : str
+        Name of the model.
+    sol : OdeResult
+        Solution of the ensemble, as returned by sweep_model.
+    label : str
+        Name of the swept parameter or initial condition.
+    profile : str, optional
+        Rendering profile, one of PROFILES. The default is 'telegram'.
+    Returns
+    -------
+    bytes
+        Image of the plot.
+    """
+    n = sol.y.shape[1]
+    fig = figure.Figure(figsize=(6.4, 2.4 * n + 0.8), dpi=PROFILES[profile]['dpi'])
+    axes = fig.subplots(n, 1, sharex=True, squeeze=False)[:, 0]
+    norm = mcolors.Normalize(sol.swept.min(), sol.swept.max())
+    buckets = int(fig.get_figwidth() * fig.dpi)
+
+    for i, ax in enumerate(axes):
+        segments = []
+        for curve in sol.y[:, i]:
+            k = downsample(curve, buckets)
+            segments.append(np.column_stack([sol.t[k], curve[k]]))
+        lines = mcollections.LineCollection(segments, cmap='viridis', norm=norm, linewidths=0.8)
+        lines.set_array(sol.swept)
+        ax.add_collection(lines)
+        ax.autoscale()
+        ax.set_ylabel('y' + str(i) + '(t)')
+    axes[-1].set_xlabel('t')
+    fig.colorbar(lines, ax=list(axes), label=label)
+    if model_name is not None:
+        axes[0].set_title(model_name)
+
+    return render(fig, profile)
 
 
 # love model
+love_params = ['aJ', 'aR', 'cJ', 'cR', 'mJ', 'mR', 'tJ', 'tR', 'kJ', 'kR', 'uJ', 'uR', 'bJ', 'bR']
 love_func = """dJdt = (p[1] + p[4] - p[8] - p[12]) *  y[0] + (p[2] - p[6] - p[10]) * y[1], 
 dRdt = (p[3] - p[7] - p[11]) * y[0] + (p[0] + p[5] - p[9] - p[13]) * y[1]"""
 
-ideal = create_model('ideal', love_func, '0, 1', '5, 17', t_eval=1000, p='0.9,0.9,0.9,0.9,0.8,0.8,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1')
-asymmetric = create_model('asymmetric', love_func, '0, 5', '3, 8', t_eval=1000, p='0.9,0.3,0.3,0.8,0.3,0.8,0.8,0.9,0.8,0.8,0.3,0.8,0.2,0.8')
-spiral = create_model('spiral', love_func, '0, 15', '10, 2', t_eval=1000, p='0.126,0.98,0.98,0.126,0.126,0.64,0.5,0.5,0.5,0.5,0.1,0.64,0.95,0.95')
+# scenarios of the Romeo and Juliet tutorial: time span, initial conditions and parameters
+scenarios = {
+    'ideal': ('0, 1', '5, 17', '0.9,0.9,0.9,0.9,0.8,0.8,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1'),
+    'asymmetric': ('0, 5', '3, 8', '0.9,0.3,0.3,0.8,0.3,0.8,0.8,0.9,0.8,0.8,0.3,0.8,0.2,0.8'),
+    'spiral': ('0, 15', '10, 2', '0.126,0.98,0.98,0.126,0.126,0.64,0.5,0.5,0.5,0.5,0.1,0.64,0.95,0.95'),
+}
+
+def __getattr__(name):
+    """Creates the models of the scenarios on first use, i.e. solver.ideal,
+    instead of when the module is imported"""
+    if name not in scenarios:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    t_span, initial_conditions, p = scenarios[name]
+    globals()[name] = create_model(name, love_func, t_span, initial_conditions, t_eval=1000, p=p)
+    return globals()[name]
@@ -0,0 +1,144 @@
+import os
+import time
+import uuid
+import tempfile
+
+import numpy as np
+
+# directory of the solutions too large to be kept in memory, written by the
+# workers and mapped by whichever process reads them
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'odebot-solutions')
+DISK_SIZE = 4 * 2**30 # bytes kept on disk, the least recently written files not in use are removed first
+
+
+def allocate(shape):
+    """Creates a .npy file on disk holding an array of floats
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array.
+    Returns
+    -------
+    tuple
+        Path of the file and the array mapped into memory for writing.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, uuid.uuid4().hex + '.npy')
+    return path, np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=shape)
+
+def evict(max_size=DISK_SIZE, keep=(), min_age=0):
+    """Removes the oldest files of DATA_DIR until they take up at most
+    max_size bytes. It is run by the process holding the solutions, as the
+    workers do not know which files are still in use, and tolerates files
+    removed by other processes meanwhile
+    Parameters
+    ----------
+    max_size : int, optional
+        Bytes the files can take up. The default is DISK_SIZE.
+    keep : set, optional
+        Paths of the files in use, which are never removed. The default is
+        none.
+    min_age : float, optional
+        Seconds since they were written before files can be removed, so the
+        ones still being written by the workers are kept. The default is 0.
+    """
+    files = []
+    for name in os.listdir(DATA_DIR) if os.path.isdir(DATA_DIR) else []:
+        path = os.path.join(DATA_DIR, name)
+        try:
+            info = os.stat(path)
+        except FileNotFoundError: # removed meanwhile
+            continue
+        if name.endswith('.npy'):
+            files.append((info.st_mtime, info.st_size, path))
+    total = sum(size for _, size, _ in files)
+    now = time.time()
+    for mtime, size, path in sorted(files):
+        if total <= max_size or now - mtime < min_age:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def references(value):
+    """Returns the paths of the files of the disk arrays held by a value,
+    i.e. a solution or the results of a job
+    Parameters
+    ----------
+    value : object
+        Value to look into, along with its items and attributes.
+    Returns
+    -------
+    set
+        Paths of the files.
+    """
+    if isinstance(value, disk_array):
+        return {value.path}
+    if isinstance(value, dict):
+        values = value.values()
+    elif isinstance(value, (list, tuple)):
+        values = value
+    elif hasattr(value, '__dict__') and not isinstance(value, (type, np.ndarray)): # i.e. the dense output of a solution
+        values = vars(value).values()
+    else:
+        return set()
+    return set().union(*(references(v) for v in values))
+
+
+class disk_array:
+    """Read only array stored in a .npy file, mapped into memory when it is
+    first used. Indexing it reads only the selected elements from disk, and
+    only the path of the file is pickled, so it is sent between processes
+    and cached without copying its data."""
+    __slots__ = ('path', 'stop', '_array')
+
+    def __init__(self, path, stop=None):
+        """Initializes the disk_array class
+        Parameters
+        ----------
+        path : str
+            Path of the .npy file.
+        stop : int, optional
+            Number of elements of the last axis that are used, the rest of the
+            file is ignored. The default is None, which uses all of them.
+        """
+        self.path = path
+        self.stop = stop
+        self._array = None
+
+    def __reduce__(self):
+        return disk_array, (self.path, self.stop)
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode='r')[..., :self.stop]
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return iter(self.array)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def dtype(self):
+        return self.array.dtype
@@ -0,0 +1,51 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import stats
+
+
+class chat_ordered_application(Application):
+    """Application handling the updates of different chats concurrently,
+    while the updates of every chat are handled one at a time in the order
+    they arrived, as its conversation expects. Updates waiting for an earlier
+    update of their chat do not take one of the handling slots, so a chat
+    sending many updates does not delay the others.
+
+    The number of updates taken from the update queue at once, handled or
+    waiting for their chat, is set with ApplicationBuilder.concurrent_updates."""
+    def __init__(self, handling=64, **kwargs):
+        """Initializes the chat_ordered_application class
+        Parameters
+        ----------
+        handling : int, optional
+            Number of updates, of different chats, handled at once. The
+            default is 64.
+        **kwargs
+            Arguments of Application, set by ApplicationBuilder.
+        """
+        super().__init__(**kwargs)
+        self.handling = handling
+        self._slots = asyncio.BoundedSemaphore(handling)
+        self._chats = {} # lock of every chat with updates, and the number of them holding or waiting for it
+
+    async def process_update(self, update):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None: # i.e. inline queries, they are not part of any conversation
+            async with self._slots:
+                with stats.timer('update.handle'):
+                    return await super().process_update(update)
+
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]: # the waiters acquire it in the order they arrived
+                async with self._slots:
+                    with stats.timer('update.handle'):
+                        await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
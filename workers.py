@@ -0,0 +1,188 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from lazy import lazy_module
+from metrics import stats
+from export import export
+
+# the jobs only run in the workers, so the bot does not import the numeric stack for them
+np = lazy_module('numpy')
+solver = lazy_module('solver')
+
+
+class PoolBusy(Exception):
+    """Raised when the queue of the worker pool is full"""
+
+class JobTimeout(Exception):
+    """Raised when a job runs for longer than the timeout of the worker pool"""
+
+
+class pool:
+    """Pool of worker processes where the models are solved and plotted so
+    the event loop of the bot is never blocked. Every worker is a single
+    process executor, so a runaway job can be killed without affecting the
+    jobs running on the other workers."""
+    def __init__(self, workers=None, queue_size=32, timeout=60):
+        """Initializes the pool class
+        Parameters
+        ----------
+        workers : int, optional
+            Number of worker processes. The default is None, which uses one
+            worker per core.
+        queue_size : int, optional
+            Number of jobs allowed to wait for a free worker. When the queue
+            is full new jobs are rejected with PoolBusy. The default is 32.
+        timeout : float, optional
+            Seconds a job can run before its worker is killed. The default is 60.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self._slots = None
+        self._executors = []
+
+    @staticmethod
+    def _job(fn, *args):
+        """Runs fn(*args) in the worker, returning its value along with the
+        metrics recorded by the worker while running it"""
+        return fn(*args), stats.drain()
+
+    def _new_executor(self):
+        # forgets the metrics the worker inherits from the bot when forked
+        executor = ProcessPoolExecutor(max_workers=1, initializer=stats.drain)
+        self._executors.append(executor)
+        return executor
+
+    def _kill(self, executor):
+        """Kills the process of an executor and discards it"""
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._executors.remove(executor)
+
+    async def run(self, fn, *args):
+        """Runs fn(*args) in a worker process
+        Parameters
+        ----------
+        fn : function
+            Function to run. It must be picklable, as well as its arguments
+            and its return value.
+        *args
+            Arguments of the function.
+        Returns
+        -------
+        object
+            Value returned by the function.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Queue()
+            for _ in range(self.workers):
+                self._slots.put_nowait(self._new_executor())
+
+        if self.pending >= self.workers + self.queue_size:
+            raise PoolBusy('The worker pool is full.')
+
+        self.pending += 1
+        try:
+            executor = await self._slots.get()
+            try:
+                with stats.timer('job.run'):
+                    result, metrics = await asyncio.wait_for(
+                        asyncio.wrap_future(executor.submit(self._job, fn, *args)), self.timeout
+                    )
+                stats.merge(metrics)
+                return result
+            except asyncio.TimeoutError:
+                self._kill(executor)
+                executor = self._new_executor()
+                stats.count('job.timeout')
+                raise JobTimeout(f'The job took longer than {self.timeout} seconds.')
+            except (asyncio.CancelledError, BrokenProcessPool):
+                self._kill(executor)
+                executor = self._new_executor()
+                raise
+            finally:
+                self._slots.put_nowait(executor)
+        finally:
+            self.pending -= 1
+
+    def pids(self):
+        """Returns the process ids of the live workers"""
+        return {pid for executor in self._executors for pid in (executor._processes or {})}
+
+    def shutdown(self):
+        """Kills every worker process of the pool"""
+        for executor in list(self._executors):
+            self._kill(executor)
+
+
+def solve_and_plot(model, name, previous=None):
+    """Job run by the workers. Solves and plots a model
+    Parameters
+    ----------
+    model : model
+        Model to solve.
+    name : str
+        Name used for the plot.
+    previous : OdeResult, optional
+        Previous solution of the model, see solver.solve_model.
+    Returns
+    -------
+    tuple
+        Solution of the model and list of the rendered images.
+    """
+    with stats.timer('solve'):
+        sol = solver.solve_model(model, previous)
+    stats.count(f'solve.method.{sol.method}')
+    stats.observe('solve.nfev', sol.nfev)
+    if sol.stopped is not None:
+        stats.count(f'solve.stopped.{sol.stopped}')
+    elif hasattr(sol.sol, 'ts'): # closed form and settled solutions do not keep their steps
+        stats.observe('solve.steps', len(sol.sol.ts) - 1)
+    with stats.timer('plot'):
+        images = solver.plot_model(name, sol)
+    return sol, images
+
+def sweep_and_plot(model, name, target, index, values, label):
+    """Job run by the workers. Solves and plots an ensemble of a model, see
+    solver.sweep_model
+    Parameters
+    ----------
+    values : 3-tuple
+        First value, last value and number of values of the sweep.
+    label : str
+        Name of the swept parameter or initial condition.
+    Returns
+    -------
+    tuple
+        Solution of the ensemble and list with the rendered image.
+    """
+    with stats.timer('sweep'):
+        sol = solver.sweep_model(model, target, index, np.linspace(*values))
+    stats.observe('sweep.nfev', sol.nfev)
+    with stats.timer('plot'):
+        images = [solver.plot_sweep(name, sol, label)]
+    return sol, images
+
+def export_solution(model, name, fmt, names, previous=None):
+    """Job run by the workers. Exports the solution of a model, resampling
+    the previous solution instead of solving it again when possible
+    Parameters
+    ----------
+    fmt : str
+        Format of the document, see export.FORMATS.
+    names : list
+        Names of the unknowns.
+    previous : OdeResult, optional
+        Previous solution of the model, see solver.solve_model.
+    Returns
+    -------
+    bytes
+        Compressed document.
+    """
+    sol = solver.solve_model(model, previous)
+    with stats.timer('export'):
+        return export(sol, fmt, names)